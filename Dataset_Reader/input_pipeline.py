@@ -0,0 +1,171 @@
+from __future__ import print_function
+
+__author__ = 'shekkizh'
+"""
+Runtime helpers for the queue based input pipeline - starvation metrics and an adaptive reader thread pool
+"""
+import threading
+import time
+import numpy as np
+import tensorflow as tf
+
+
+class InputMonitor(object):
+    """
+    Samples the batch queue fill level, the decode rate and (from traced steps) the time the train step spent blocked
+    in the batch dequeue. Metrics go to the summary writer (if any) and a console line every log_every steps.
+    """
+
+    def __init__(self, queue_size, examples_decoded, capacity, batch_size, dequeue_op_name, summary_writer,
+                 sample_every=10, trace_every=100, log_every=200, reader_pool=None):
+        self.queue_size = queue_size
+        self.examples_decoded = examples_decoded
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.dequeue_op_name = dequeue_op_name
+        self.summary_writer = summary_writer
+        self.sample_every = sample_every
+        self.trace_every = trace_every
+        self.log_every = log_every
+        self.reader_pool = reader_pool
+        self._reset_window()
+        self.decode_rate = 0.0
+        self._last_decoded = None
+        self._last_time = None
+
+    def _reset_window(self):
+        self._fill_samples = []
+        self._dequeue_waits = []
+
+    def run_kwargs(self, itr):
+        """
+        Extra sess.run arguments for the train op of this step - a full trace on every trace_every-th step.
+        """
+        if itr % self.trace_every != 0:
+            return {}
+        return {"options": tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                "run_metadata": tf.RunMetadata()}
+
+    def _dequeue_wait_ms(self, run_metadata):
+        for device_stats in run_metadata.step_stats.dev_stats:
+            for node_stats in device_stats.node_stats:
+                if node_stats.node_name == self.dequeue_op_name:
+                    return node_stats.all_end_rel_micros / 1000.0
+        return None
+
+    def step(self, sess, itr, run_kwargs):
+        if "run_metadata" in run_kwargs:
+            wait_ms = self._dequeue_wait_ms(run_kwargs["run_metadata"])
+            if wait_ms is not None:
+                self._dequeue_waits.append(wait_ms)
+
+        if itr % self.sample_every == 0:
+            queue_size, examples_decoded = sess.run([self.queue_size, self.examples_decoded])
+            self._fill_samples.append(queue_size)
+            if self.reader_pool is not None:
+                self.reader_pool.adjust(float(queue_size) / self.reader_pool.target_capacity)
+            now = time.time()
+            if self._last_time is not None:
+                self.decode_rate = (examples_decoded - self._last_decoded) / (now - self._last_time)
+            self._last_decoded, self._last_time = examples_decoded, now
+
+        if itr % self.log_every == 0 and self._fill_samples:
+            self.log(itr)
+
+    def log(self, itr):
+        fill_samples = np.array(self._fill_samples, dtype=np.float32)
+        fill_level = fill_samples.mean() / self.capacity
+        starved = np.mean(fill_samples < self.batch_size)
+        dequeue_wait = np.mean(self._dequeue_waits) if self._dequeue_waits else 0.0
+        decode_rate = self.decode_rate
+        threads = self.reader_pool.num_threads if self.reader_pool is not None else 0
+
+        print("Input: queue %.1f%% full, starved %.0f%% of samples, dequeue wait %.2f ms, decode %.1f images/sec%s" % (
+            100 * fill_level, 100 * starved, dequeue_wait, decode_rate,
+            ", readers %d" % threads if self.reader_pool is not None else ""))
+        values = [tf.Summary.Value(tag="input/fill_level", simple_value=fill_level),
+                  tf.Summary.Value(tag="input/starved_fraction", simple_value=starved),
+                  tf.Summary.Value(tag="input/dequeue_wait_ms", simple_value=dequeue_wait),
+                  tf.Summary.Value(tag="input/decode_images_per_sec", simple_value=decode_rate)]
+        if self.reader_pool is not None:
+            values.append(tf.Summary.Value(tag="input/reader_threads", simple_value=threads))
+            values.append(tf.Summary.Value(tag="input/target_capacity", simple_value=self.reader_pool.target_capacity))
+        if self.summary_writer is not None:
+            self.summary_writer.add_summary(tf.Summary(value=values), itr)
+        self._reset_window()
+
+
+class ReaderPool(object):
+    """
+    Runs the reader/decode enqueue op on a variable number of threads. The queue is built with the largest allowed
+    capacity and the pool enforces a smaller soft capacity, so both can grow or shrink while training runs.
+    """
+
+    def __init__(self, sess, coord, enqueue_op, close_op, queue_size, batch_size, max_capacity, num_threads=4,
+                 min_threads=1, max_threads=16, capacity=None, threads=None):
+        self.sess = sess
+        self.coord = coord
+        self.enqueue_op = enqueue_op
+        self.close_op = close_op
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.max_capacity = max_capacity
+        self.min_threads = min_threads
+        self.max_threads = max_threads
+        self.min_capacity = 2 * batch_size
+        self.target_capacity = capacity or max_capacity
+        self.threads = threads if threads is not None else []
+        self._stop_events = []
+        self._lock = threading.Lock()
+        closer = threading.Thread(target=self._close_on_stop)
+        closer.daemon = True
+        closer.start()
+        self.threads.append(closer)
+        for _ in range(num_threads):
+            self._add_thread()
+
+    @property
+    def num_threads(self):
+        return len(self._stop_events)
+
+    def _close_on_stop(self):
+        self.coord.wait_for_stop()
+        try:
+            self.sess.run(self.close_op)
+        except Exception:
+            pass
+
+    def _run(self, stop_event):
+        try:
+            while not self.coord.should_stop() and not stop_event.is_set():
+                if self.sess.run(self.queue_size) >= self.target_capacity:
+                    time.sleep(0.005)
+                    continue
+                self.sess.run(self.enqueue_op)
+        except (tf.errors.OutOfRangeError, tf.errors.CancelledError):
+            self.coord.request_stop()
+        except Exception as e:
+            self.coord.request_stop(e)
+
+    def _add_thread(self):
+        stop_event = threading.Event()
+        thread = threading.Thread(target=self._run, args=(stop_event,))
+        thread.daemon = True
+        thread.start()
+        self._stop_events.append(stop_event)
+        self.threads.append(thread)
+
+    def adjust(self, fill_fraction):
+        """
+        Grow threads and soft capacity while the queue runs low, shed a thread and a batch of capacity while it stays
+        nearly full.
+        """
+        with self._lock:
+            if fill_fraction < 0.25:
+                if self.num_threads < self.max_threads:
+                    self._add_thread()
+                self.target_capacity = min(self.max_capacity, self.target_capacity + self.batch_size)
+            elif fill_fraction > 0.9:
+                if self.num_threads > self.min_threads:
+                    self._stop_events.pop().set()
+                self.target_capacity = max(self.min_capacity, self.target_capacity - self.batch_size)
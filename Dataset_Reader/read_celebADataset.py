@@ -1,18 +1,29 @@
+from __future__ import print_function
+
 __author__ = 'charlie'
 import numpy as np
 import os, sys, inspect
 import random
-from six.moves import cPickle as pickle
-from tensorflow.python.platform import gfile
+import time
+import multiprocessing
+import hashlib
 import glob
+from PIL import Image
 
 utils_path = os.path.abspath(
     os.path.realpath(os.path.join(os.path.split(inspect.getfile(inspect.currentframe()))[0], "..")))
 if utils_path not in sys.path:
     sys.path.insert(0, utils_path)
 import utils as utils
+from Dataset_Reader.zip_archive import ZipImageArchive, load_zip_index
 
 DATA_URL = 'https://www.dropbox.com/sh/8oqt9vytwxb3s4r/AADIKlz8PR9zr6Y20qbkunrba/Img/img_align_celeba.zip'
+CROP_OFFSET = (55, 35)  # (top, left) of the face crop inside the 178x218 aligned frame
+MANIFEST_FILENAME = "celebA_manifest.npy"
+ZIP_INDEX_FILENAME = "celebA_zip_index.npy"
+SPLITS = {'train': 0, 'test': 1, 'validation': 2}
+PYRAMID_SIZES = (128, 64, 32)  # image cache levels built alongside the requested size
+CACHE_VERSION = 2  # bumped whenever preprocess_image changes the cached pixels
 random.seed(5)
 
 
@@ -21,70 +32,358 @@ class CelebA_Dataset():
         self.train_images = dict['train']
         self.test_images = dict['test']
         self.validation_images = dict['validation']
+        self.train_image_cache = None
+        self.train_digest = None
+        self.archive = None
+
+
+class ImageCacheSampler(object):
+    """
+    Serves random batches from a memory-mapped N x H x W x 3 uint8 image cache.
+    Every epoch walks a fresh permutation; indices within a batch are sorted so reads stay page friendly.
+    """
 
+    def __init__(self, image_cache, batch_size):
+        self.image_cache = image_cache
+        self.batch_size = batch_size
+        self._order = np.random.permutation(image_cache.shape[0])
+        self._offset = 0
 
-def read_dataset(data_dir):
-    pickle_filename = "celebA.pickle"
-    pickle_filepath = os.path.join(data_dir, pickle_filename)
-    if not os.path.exists(pickle_filepath):
+    def __call__(self):
+        if self._offset + self.batch_size > len(self._order):
+            self._order = np.random.permutation(self.image_cache.shape[0])
+            self._offset = 0
+        indices = np.sort(self._order[self._offset:self._offset + self.batch_size])
+        self._offset += self.batch_size
+        return self.image_cache[indices]
+
+
+def read_dataset(data_dir, image_cache_size=None, refresh=False):
+    """
+    :param data_dir: directory holding celebA_manifest.npy / the extracted img_align_celeba folder
+    :param image_cache_size: optional (crop_image_size, resized_image_size). When given, the training images are
+    decoded, cropped and resized once into a pyramid of memory-mapped uint8 caches. The level matching
+    resized_image_size (or the nearest larger one) is attached as train_image_cache.
+    :param refresh: stat-diff the image folder even if its mtime says no files were added or removed
+    """
+    manifest_filepath = os.path.join(data_dir, MANIFEST_FILENAME)
+    celebA_folder = os.path.splitext(DATA_URL.split("/")[-1])[0]
+    dir_path = os.path.join(data_dir, celebA_folder)
+    if not os.path.exists(manifest_filepath):
         # utils.maybe_download_and_extract(data_dir, DATA_URL, is_zipfile=True)
-        celebA_folder = os.path.splitext(DATA_URL.split("/")[-1])[0]
-        dir_path = os.path.join(data_dir, celebA_folder)
         if not os.path.exists(dir_path):
             print ("CelebA dataset needs to be downloaded and unzipped manually")
             print ("Download from: %s" % DATA_URL)
             raise ValueError("Dataset not found")
-
-        result = create_image_lists(dir_path)
-        print ("Training set: %d" % len(result['train']))
-        print ("Test set: %d" % len(result['test']))
-        print ("Validation set: %d" % len(result['validation']))
-        print ("Pickling ...")
-        with open(pickle_filepath, 'wb') as f:
-            pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+        manifest = update_manifest(dir_path, None)
+        _save_atomic(manifest_filepath, manifest)
     else:
-        print ("Found pickle file!")
+        print ("Found manifest file!")
+        manifest = np.load(manifest_filepath)
+        if os.path.exists(dir_path) and (refresh or os.path.getmtime(dir_path) > os.path.getmtime(manifest_filepath)):
+            updated_manifest = update_manifest(dir_path, manifest)
+            if updated_manifest is not manifest:
+                manifest = updated_manifest
+                _save_atomic(manifest_filepath, manifest)
+            else:
+                os.utime(manifest_filepath, None)
 
-    with open(pickle_filepath, 'rb') as f:
-        result = pickle.load(f)
-        celebA = CelebA_Dataset(result)
-        del result
+    result = {}
+    for split_name, split_id in SPLITS.items():
+        result[split_name] = [os.path.join(dir_path, name.decode()) for name in
+                              manifest['name'][manifest['split'] == split_id]]
+    celebA = CelebA_Dataset(result)
+    celebA.train_digest = train_digest(manifest)
+    print ("Training set: %d" % len(celebA.train_images))
+    print ("Test set: %d" % len(celebA.test_images))
+    print ("Validation set: %d" % len(celebA.validation_images))
+
+    if image_cache_size is not None:
+        crop_image_size, resized_image_size = image_cache_size
+        # Use the matching pyramid level, else the nearest larger one (resized on the fly by the reader)
+        larger_sizes = [size for size in cached_image_sizes(data_dir, crop_image_size, celebA.train_digest)
+                        if size >= resized_image_size]
+        if not larger_sizes:
+            build_image_cache(data_dir, celebA.train_images, celebA.train_digest, crop_image_size,
+                              pyramid_sizes(crop_image_size, resized_image_size))
+            larger_sizes = [resized_image_size]
+        cache_path = image_cache_path(data_dir, crop_image_size, min(larger_sizes))
+        print ("Using image cache %s" % cache_path)
+        celebA.train_image_cache = np.load(cache_path, mmap_mode='r')
     return celebA
 
 
-def create_image_lists(image_dir, testing_percentage=0.0, validation_percentage=0.0):
+def read_zip_dataset(data_dir, testing_percentage=0.0, validation_percentage=0.0):
     """
-    Code modified from tensorflow/tensorflow/examples/image_retraining
+    Serves the images straight out of the original img_align_celeba.zip in data_dir - no extraction step.
+    The *_images lists hold positions into celebA.archive instead of file paths.
     """
-    if not gfile.Exists(image_dir):
-        print("Image directory '" + image_dir + "' not found.")
-        return None
-    training_images = []
-    extensions = ['jpg', 'jpeg', 'JPG', 'JPEG']
-    sub_dirs = [x[0] for x in os.walk(image_dir)]
-    file_list = []
+    zip_path = os.path.join(data_dir, DATA_URL.split("/")[-1])
+    if not os.path.exists(zip_path):
+        print ("CelebA zip needs to be downloaded manually")
+        print ("Download from: %s" % DATA_URL)
+        raise ValueError("Dataset not found")
+    index = load_zip_index(zip_path, os.path.join(data_dir, ZIP_INDEX_FILENAME))
+    archive = ZipImageArchive(zip_path, index)
+    print ("Found %d images in %s (%d stored, memory-mapped)" % (len(archive), zip_path, archive.no_of_stored))
+
+    splits = np.array([_split_for_name(os.path.basename(name), testing_percentage, validation_percentage)
+                       for name in index['name']], dtype=np.uint8)
+    result = {}
+    for split_name, split_id in SPLITS.items():
+        result[split_name] = np.flatnonzero(splits == split_id).tolist()
+    celebA = CelebA_Dataset(result)
+    celebA.archive = archive
+    print ("Training set: %d" % len(celebA.train_images))
+    return celebA
+
 
-    for extension in extensions:
-        file_glob = os.path.join(image_dir, '*.' + extension)
-        file_list.extend(glob.glob(file_glob))
+def _manifest_array(no_of_entries, name_length):
+    return np.zeros(no_of_entries, dtype=[('name', 'S%d' % name_length), ('size', np.int64), ('mtime', np.float64),
+                                          ('hash', np.uint64), ('split', np.uint8)])
 
-    if not file_list:
+
+def _content_hash(filepath):
+    with open(filepath, 'rb') as f:
+        return int(hashlib.md5(f.read()).hexdigest()[:16], 16)
+
+
+def train_digest(manifest):
+    """
+    Digest of the names and content hashes of the training entries, in order - the rows of an image cache - and of
+    CACHE_VERSION.
+    """
+    train_entries = manifest[manifest['split'] == SPLITS['train']]
+    digest = hashlib.md5(("%d\n" % CACHE_VERSION).encode())
+    digest.update(b"\n".join(train_entries['name']))
+    digest.update(train_entries['hash'].astype('<u8').tobytes())
+    return digest.hexdigest()
+
+
+def _split_for_name(name, testing_percentage, validation_percentage):
+    """
+    Split assignment depends only on the file name, so it never changes when other files come and go.
+    """
+    bucket = int(hashlib.md5(name).hexdigest()[:8], 16) % 10000 / 10000.0
+    if bucket < validation_percentage:
+        return SPLITS['validation']
+    if bucket < validation_percentage + testing_percentage:
+        return SPLITS['test']
+    return SPLITS['train']
+
+
+def update_manifest(image_dir, manifest, testing_percentage=0.0, validation_percentage=0.0):
+    """
+    Stat-diffs image_dir against manifest (None for a fresh build). Entries whose size/mtime changed are re-hashed,
+    removed files are dropped and new files are appended in shuffled order, so the order and split of existing
+    entries are preserved. Returns manifest itself when nothing changed.
+    """
+    extensions = ('.jpg', '.jpeg', '.JPG', '.JPEG')
+    on_disk = {}
+    for name in os.listdir(image_dir):
+        if name.endswith(extensions):
+            stat = os.stat(os.path.join(image_dir, name))
+            on_disk[name.encode()] = (stat.st_size, stat.st_mtime)
+    if not on_disk:
         print('No files found')
+
+    if manifest is None:
+        manifest = _manifest_array(0, 1)
+    keep = np.array([name in on_disk for name in manifest['name']], dtype=np.bool_)
+    known_names = set(manifest['name'])
+    new_names = sorted(name for name in on_disk if name not in known_names)
+    random.shuffle(new_names)
+    name_length = max([1] + [len(name) for name in on_disk])
+
+    updated = _manifest_array(int(keep.sum()) + len(new_names), name_length)
+    no_of_kept = int(keep.sum())
+    for field in ('name', 'size', 'mtime', 'hash', 'split'):
+        updated[field][:no_of_kept] = manifest[field][keep]
+    updated['name'][no_of_kept:] = new_names
+
+    no_of_changed = 0
+    for index, name in enumerate(updated['name']):
+        size, mtime = on_disk[name]
+        if index < no_of_kept and updated['size'][index] == size and updated['mtime'][index] == mtime:
+            continue
+        updated['size'][index] = size
+        updated['mtime'][index] = mtime
+        updated['hash'][index] = _content_hash(os.path.join(image_dir, name.decode()))
+        if index >= no_of_kept:
+            updated['split'][index] = _split_for_name(name, testing_percentage, validation_percentage)
+        else:
+            no_of_changed += 1
+
+    print ("Manifest: %d kept, %d added, %d removed, %d modified" % (
+        no_of_kept, len(new_names), len(manifest) - no_of_kept, no_of_changed))
+    if not new_names and no_of_kept == len(manifest) and no_of_changed == 0:
+        return manifest
+    return updated
+
+
+def _save_atomic(filepath, array):
+    with open(filepath + ".tmp", 'wb') as f:
+        np.save(f, array)
+    os.rename(filepath + ".tmp", filepath)
+
+
+def image_cache_path(data_dir, crop_image_size, resized_image_size):
+    return os.path.join(data_dir, "celebA_%d_%d.npy" % (crop_image_size, resized_image_size))
+
+
+def image_cache_digest_path(data_dir, crop_image_size, resized_image_size):
+    """
+    Holds the train_digest of the images a cache level was built from.
+    """
+    return os.path.splitext(image_cache_path(data_dir, crop_image_size, resized_image_size))[0] + ".digest"
+
+
+def _read_digest(digest_path):
+    if not os.path.exists(digest_path):
+        return None
+    with open(digest_path) as f:
+        return f.read().strip()
+
+
+def cached_image_sizes(data_dir, crop_image_size, digest):
+    """
+    Resized sizes of the pyramid levels already cached for crop_image_size and built from the training images with
+    train_digest digest - levels of a since renamed, replaced, added or removed image are not reported.
+    """
+    sizes = []
+    for cache_path in glob.glob(os.path.join(data_dir, "celebA_%d_*.npy" % crop_image_size)):
+        size = os.path.splitext(cache_path)[0].split("_")[-1]
+        if size.isdigit() and _read_digest(image_cache_digest_path(data_dir, crop_image_size, int(size))) == digest:
+            sizes.append(int(size))
+    return sorted(sizes)
+
+
+def pyramid_sizes(crop_image_size, resized_image_size):
+    return sorted(set([resized_image_size] + [size for size in PYRAMID_SIZES if size <= crop_image_size]),
+                  reverse=True)
+
+
+def resize_bilinear(image, size):
+    """
+    Numpy port of tf.image.resize_bilinear (align_corners=False) for one H x W x C float32 image - same sampling
+    positions and float32 arithmetic, no antialiasing on downscale.
+    """
+    def interpolation_weights(in_size):
+        position = np.arange(size, dtype=np.float32) * (np.float32(in_size) / np.float32(size))
+        lower = np.floor(position)
+        upper = np.minimum(np.ceil(position), in_size - 1)
+        return lower.astype(np.int64), upper.astype(np.int64), position - lower
+
+    top, bottom, y_lerp = interpolation_weights(image.shape[0])
+    left, right, x_lerp = interpolation_weights(image.shape[1])
+    x_lerp = x_lerp[np.newaxis, :, np.newaxis]
+    top_row = image[top][:, left] + (image[top][:, right] - image[top][:, left]) * x_lerp
+    bottom_row = image[bottom][:, left] + (image[bottom][:, right] - image[bottom][:, left]) * x_lerp
+    return top_row + (bottom_row - top_row) * y_lerp[:, np.newaxis, np.newaxis]
+
+
+def preprocess_image(image_path, crop_image_size, resized_image_sizes):
+    """
+    Numpy equivalent of GAN._decode_image ("full" decode mode) - decode, crop the face box once and bilinear resize
+    it to every size in resized_image_sizes (uint8). The resize and rounding repeat the TensorFlow ops, so the
+    pixels differ from the queue backend only where PIL's libjpeg IDCT (accurate integer) and TensorFlow's (fast
+    integer) disagree - input_benchmark.py --compare_cache measures by how much.
+    """
+    with Image.open(image_path) as image:
+        image = np.asarray(image.convert('RGB'))
+    top, left = CROP_OFFSET
+    cropped_image = image[top:top + crop_image_size, left:left + crop_image_size].astype(np.float32)
+    return [np.clip(np.round(resize_bilinear(cropped_image, size)), 0, 255).astype(np.uint8)
+            for size in resized_image_sizes]
+
+
+def _build_image_chunk(args):
+    """
+    Pool worker - preprocesses one chunk of images straight into its slice of every partial level file.
+    """
+    tmp_paths, chunk_index, start, image_paths, crop_image_size, resized_image_sizes = args
+    levels = [np.load(tmp_path, mmap_mode='r+') for tmp_path in tmp_paths]
+    for offset, image_path in enumerate(image_paths):
+        for images, resized_image in zip(levels, preprocess_image(image_path, crop_image_size, resized_image_sizes)):
+            images[start + offset] = resized_image
+    for images in levels:
+        images.flush()
+    del levels
+    return chunk_index
+
+
+def build_image_cache(data_dir, image_list, digest, crop_image_size, resized_image_sizes, num_workers=None,
+                      chunk_size=500):
+    """
+    Writes image_list as one contiguous N x H x W x 3 uint8 .npy file (loadable with mmap_mode='r') per size in
+    resized_image_sizes - a pyramid of the same crop. Missing levels are built together in one pass, so every image
+    is decoded and cropped once no matter how many levels are requested. Each level records digest (the
+    train_digest of image_list) next to it, and levels recorded with another digest are rebuilt.
+    Chunks of chunk_size consecutive images are preprocessed on a pool of num_workers processes (default: all cores).
+    Levels are written under a temporary name next to a per-chunk completion map, so a killed build resumes with
+    the unfinished chunks and an incomplete cache is never picked up.
+    """
+    cache_paths = [image_cache_path(data_dir, crop_image_size, size) for size in resized_image_sizes]
+    cached_sizes = cached_image_sizes(data_dir, crop_image_size, digest)
+    build_sizes = [size for size in resized_image_sizes if size not in cached_sizes]
+    if not build_sizes:
+        print ("Found image cache %s" % ", ".join(cache_paths))
+        return cache_paths
+
+    shapes = [(len(image_list), size, size, 3) for size in build_sizes]
+    tmp_paths = [os.path.splitext(image_cache_path(data_dir, crop_image_size, size))[0] + ".partial"
+                 for size in build_sizes]
+    no_of_chunks = (len(image_list) + chunk_size - 1) // chunk_size
+    # a partial build of other images is not resumed
+    done_path = os.path.join(data_dir, "celebA_%d_%s_%s.done.npy" % (crop_image_size, "-".join(map(str, build_sizes)),
+                                                                     digest[:16]))
+    if os.path.exists(done_path) and np.load(done_path).shape == (no_of_chunks,) and \
+            all(os.path.exists(tmp_path) and np.load(tmp_path, mmap_mode='r').shape == shape
+                for tmp_path, shape in zip(tmp_paths, shapes)):
+        chunks_done = np.load(done_path)
+        print ("Resuming image cache levels %s (%d/%d chunks done)" % (build_sizes, chunks_done.sum(), no_of_chunks))
     else:
-        # print "No. of files found: %d" % len(file_list)
-        training_images.extend([f for f in file_list])
-
-    random.shuffle(training_images)
-    no_of_images = len(training_images)
-    validation_offset = int(validation_percentage * no_of_images)
-    validation_images = training_images[:validation_offset]
-    test_offset = int(testing_percentage * no_of_images)
-    testing_images = training_images[validation_offset:validation_offset + test_offset]
-    training_images = training_images[validation_offset + test_offset:]
-
-    result = {
-        'train': training_images,
-        'test': testing_images,
-        'validation': validation_images,
-    }
-    return result
+        print ("Building image cache levels %s for crop %d ..." % (build_sizes, crop_image_size))
+        for tmp_path, shape in zip(tmp_paths, shapes):
+            images = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=shape)
+            del images
+        chunks_done = np.zeros(no_of_chunks, dtype=np.bool_)
+        _save_atomic(done_path, chunks_done)
+
+    tasks = [(tmp_paths, chunk_index, chunk_index * chunk_size,
+              image_list[chunk_index * chunk_size:(chunk_index + 1) * chunk_size], crop_image_size, build_sizes)
+             for chunk_index in range(no_of_chunks) if not chunks_done[chunk_index]]
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        start_time = time.time()
+        for count, chunk_index in enumerate(pool.imap_unordered(_build_image_chunk, tasks)):
+            chunks_done[chunk_index] = True
+            _save_atomic(done_path, chunks_done)
+            duration = time.time() - start_time
+            print ("\r>> Cached %d/%d chunks, %.1f images/sec" % (
+                chunks_done.sum(), no_of_chunks, (count + 1) * chunk_size / duration), end="")
+            sys.stdout.flush()
+        print ()
+    finally:
+        pool.close()
+        pool.join()
+
+    for tmp_path, size in zip(tmp_paths, build_sizes):
+        digest_path = image_cache_digest_path(data_dir, crop_image_size, size)
+        if os.path.exists(digest_path):
+            os.remove(digest_path)
+        os.rename(tmp_path, image_cache_path(data_dir, crop_image_size, size))
+        with open(digest_path + ".tmp", 'w') as f:
+            f.write(digest)
+        os.rename(digest_path + ".tmp", digest_path)
+    os.remove(done_path)
+    return cache_paths
+
+
+def build(data_dir, crop_image_size, resized_image_sizes, num_workers=None, chunk_size=500):
+    """
+    One-off preprocessing pass - builds the training image cache levels used by the "cache" input backend.
+    """
+    celebA = read_dataset(data_dir)
+    return build_image_cache(data_dir, celebA.train_images, celebA.train_digest, crop_image_size, resized_image_sizes,
+                             num_workers=num_workers, chunk_size=chunk_size)
@@ -0,0 +1,70 @@
+from __future__ import print_function
+
+__author__ = 'charlie'
+"""
+Synthetic stand-in for CelebA, laid out like the real download, so the input pipelines can run without it
+"""
+import os
+import json
+import shutil
+import zipfile
+import numpy as np
+from PIL import Image
+
+SPEC_FILENAME = "synthetic_celebA.json"
+
+
+def _synthetic_image(random_state, width, height):
+    # Smooth colour gradients plus noise - compresses roughly like a photo rather than flat colour or pure noise
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    image = np.empty((height, width, 3), dtype=np.float32)
+    for channel in range(3):
+        fx, fy, phase = random_state.uniform(0.005, 0.05, size=2).tolist() + [random_state.uniform(0, np.pi)]
+        image[..., channel] = 127.5 + 90 * np.sin(fx * x + fy * y + phase)
+    image += random_state.normal(0, 12, size=image.shape)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def generate_synthetic_dataset(data_dir, no_of_images, width=178, height=218, seed=5):
+    """
+    Writes no_of_images JPEGs to data_dir/img_align_celeba and the same files, stored, in
+    data_dir/img_align_celeba.zip. A corpus generated with the same arguments (recorded in SPEC_FILENAME) is
+    reused, so repeated calls are cheap - any other corpus in data_dir is deleted and regenerated.
+    :return: path of the image folder
+    """
+    image_dir = os.path.join(data_dir, "img_align_celeba")
+    zip_path = os.path.join(data_dir, "img_align_celeba.zip")
+    spec_path = os.path.join(data_dir, SPEC_FILENAME)
+    spec = {"no_of_images": no_of_images, "width": width, "height": height, "seed": seed}
+    existing_spec = None
+    if os.path.exists(spec_path):
+        with open(spec_path) as f:
+            existing_spec = json.load(f)
+    if existing_spec != spec and (os.path.exists(image_dir) or os.path.exists(zip_path)):
+        print("Regenerating synthetic dataset in %s (was %s)" % (data_dir, existing_spec))
+        if os.path.exists(spec_path):
+            os.remove(spec_path)
+        if os.path.exists(image_dir):
+            shutil.rmtree(image_dir)
+        if os.path.exists(zip_path):
+            os.remove(zip_path)
+    if not os.path.exists(image_dir):
+        os.makedirs(image_dir)
+
+    random_state = np.random.RandomState(seed)
+    names = ["%06d.jpg" % (index + 1) for index in range(no_of_images)]
+    for name in names:
+        image = _synthetic_image(random_state, width, height)
+        image_path = os.path.join(image_dir, name)
+        if not os.path.exists(image_path):
+            Image.fromarray(image).save(image_path)
+
+    if not os.path.exists(zip_path):
+        with zipfile.ZipFile(zip_path + ".tmp", 'w', zipfile.ZIP_STORED) as zf:
+            for name in names:
+                zf.write(os.path.join(image_dir, name), "img_align_celeba/" + name)
+        os.rename(zip_path + ".tmp", zip_path)
+    with open(spec_path, 'w') as f:
+        json.dump(spec, f)
+    print("Synthetic dataset: %d images of %dx%d in %s" % (no_of_images, width, height, data_dir))
+    return image_dir
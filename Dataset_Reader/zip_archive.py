@@ -0,0 +1,83 @@
+from __future__ import print_function
+
+__author__ = 'charlie'
+"""
+Random access to the members of a zip archive without extracting it
+"""
+import os
+import mmap
+import struct
+import zipfile
+import zlib
+import numpy as np
+
+LOCAL_HEADER_FORMAT = '<4s5H3I2H'
+LOCAL_HEADER_SIZE = struct.calcsize(LOCAL_HEADER_FORMAT)
+
+
+def build_zip_index(zip_path, extensions=('.jpg', '.jpeg', '.JPG', '.JPEG')):
+    """
+    Reads the central directory once and resolves where each member's data starts, so members can later be served
+    by offset. Returns a structured array (name, data_offset, compress_size, file_size, compress_type).
+    """
+    with zipfile.ZipFile(zip_path) as zf:
+        members = [info for info in zf.infolist() if info.filename.endswith(extensions)]
+    name_length = max([1] + [len(info.filename.encode()) for info in members])
+    index = np.zeros(len(members), dtype=[('name', 'S%d' % name_length), ('data_offset', np.int64),
+                                          ('compress_size', np.int64), ('file_size', np.int64),
+                                          ('compress_type', np.uint8)])
+    with open(zip_path, 'rb') as f:
+        for i, info in enumerate(members):
+            f.seek(info.header_offset)
+            header = struct.unpack(LOCAL_HEADER_FORMAT, f.read(LOCAL_HEADER_SIZE))
+            if header[0] != b'PK\x03\x04':
+                raise ValueError("Bad local file header for %s in %s" % (info.filename, zip_path))
+            filename_length, extra_length = header[9], header[10]
+            index[i] = (info.filename.encode(), info.header_offset + LOCAL_HEADER_SIZE + filename_length + extra_length,
+                        info.compress_size, info.file_size, info.compress_type)
+    return index
+
+
+class ZipImageArchive(object):
+    """
+    Memory-maps a zip archive and serves member bytes by position in its index. Stored members are plain slices of
+    the mapping; deflated members are inflated on the fly.
+    """
+
+    def __init__(self, zip_path, index):
+        self.zip_path = zip_path
+        self.index = index
+        self._file = open(zip_path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.no_of_stored = int(np.sum(index['compress_type'] == zipfile.ZIP_STORED))
+
+    def __len__(self):
+        return len(self.index)
+
+    def read(self, position):
+        entry = self.index[position]
+        start = int(entry['data_offset'])
+        data = self._mmap[start:start + int(entry['compress_size'])]
+        if entry['compress_type'] == zipfile.ZIP_STORED:
+            return data
+        elif entry['compress_type'] == zipfile.ZIP_DEFLATED:
+            return zlib.decompress(data, -15)
+        raise ValueError("Unsupported compression %d for %s" % (entry['compress_type'], entry['name']))
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+
+def load_zip_index(zip_path, index_path):
+    """
+    Cached build_zip_index - the index is rebuilt only when the archive is newer than the saved index.
+    """
+    if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(zip_path):
+        return np.load(index_path)
+    print("Indexing %s ..." % zip_path)
+    index = build_zip_index(zip_path)
+    with open(index_path + ".tmp", 'wb') as f:
+        np.save(f, index)
+    os.rename(index_path + ".tmp", index_path)
+    return index
@@ -0,0 +1 @@
+python main.py --logs_dir=logs/CelebA_WGAN_logs4/ --optimizer=RMSProp --learning_rate=5e-5 --optimizer_param=0.9 --model=1 --mode=autotune --data_dir=./
@@ -0,0 +1 @@
+python main.py --data_dir=./ --image_size=108,64 --mode=build --num_workers=32
@@ -0,0 +1,8 @@
+# One parameter server and two workers on this machine, worker 0 is the chief and writes checkpoints/summaries
+ARGS="--logs_dir=logs/CelebA_WGAN_distributed/ --optimizer=RMSProp --learning_rate=5e-5 --optimizer_param=0.9 --model=1 --iterations=1e5 --mode=train --data_dir=./ --ps_hosts=localhost:2222 --worker_hosts=localhost:2223,localhost:2224"
+python main.py $ARGS --job_name=ps --task_index=0 &
+PS_PID=$!
+python main.py $ARGS --job_name=worker --task_index=1 &
+python main.py $ARGS --job_name=worker --task_index=0
+wait %2
+kill $PS_PID
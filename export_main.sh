@@ -0,0 +1,2 @@
+python main.py --logs_dir=logs/CelebA_WGAN_logs4/ --model=1 --mode=export --export_dir=logs/CelebA_WGAN_generator/
+python main.py --logs_dir=logs/CelebA_WGAN_samples/ --mode=sample --export_dir=logs/CelebA_WGAN_generator/ --no_of_samples=10000 --sample_batch_size=256
@@ -0,0 +1,202 @@
+from __future__ import print_function
+
+__author__ = "shekkizh"
+"""
+Input pipeline benchmark - throughput, per-stage latency and peak RSS of every GAN input backend.
+Runs against the real dataset in data_dir, or a generated synthetic corpus with --synthetic_images.
+"""
+import json
+import multiprocessing
+import time
+import numpy as np
+import tensorflow as tf
+from models.GAN_models import GAN
+import utils as utils
+import Dataset_Reader.read_celebADataset as celebA
+from Dataset_Reader.synthetic_celebA import generate_synthetic_dataset
+
+FLAGS = tf.flags.FLAGS
+tf.flags.DEFINE_integer("batch_size", "64", "batch size to read")
+tf.flags.DEFINE_string("data_dir", "Data_zoo/CelebA_faces/", "path to dataset")
+tf.flags.DEFINE_string("image_size", "108,64", "Size of actual images, Size of images to be generated at.")
+tf.flags.DEFINE_string("backends", "queue,cache,dataset,zip", "comma separated input backends to compare")
+tf.flags.DEFINE_integer("num_reader_threads", "4", "reader/decode threads of the queue and dataset backends")
+tf.flags.DEFINE_string("decode_mode", "full", "decode mode used by the backends")
+tf.flags.DEFINE_string("decode_modes", "full,crop,crop_dct", "comma separated decode modes to compare per image")
+tf.flags.DEFINE_integer("decode_images", "500", "images decoded per mode in the decode comparison")
+tf.flags.DEFINE_bool("compare_cache", True, "measure the image cache pixels' deviation from the queue backend decode")
+tf.flags.DEFINE_float("max_cache_diff", "0", "fail when the mean cache deviation exceeds this many levels (0 - report only)")
+tf.flags.DEFINE_integer("warmup_steps", "20", "batches read before timing starts")
+tf.flags.DEFINE_integer("steps", "200", "batches read while timing")
+tf.flags.DEFINE_integer("synthetic_images", "0", "generate a synthetic corpus of this many images in data_dir (0 - off)")
+tf.flags.DEFINE_string("synthetic_resolution", "178x218", "width x height of the synthetic images")
+tf.flags.DEFINE_string("json_output", "", "write the results to this JSON file")
+
+
+def benchmark_backend(backend, crop_image_size, resized_image_size):
+    model = GAN(100, crop_image_size, resized_image_size, FLAGS.batch_size, FLAGS.data_dir, input_backend=backend,
+                num_reader_threads=FLAGS.num_reader_threads, decode_mode=FLAGS.decode_mode)
+    with tf.Session() as sess:
+        sess.run(tf.local_variables_initializer())
+        coord = tf.train.Coordinator()
+        threads = tf.train.start_queue_runners(sess, coord)
+        try:
+            for _ in range(FLAGS.warmup_steps):
+                sess.run(model.images)
+            batch_times = []
+            for _ in range(FLAGS.steps):
+                start_time = time.time()
+                sess.run(model.images)
+                batch_times.append(time.time() - start_time)
+        finally:
+            coord.request_stop()
+            coord.join(threads)
+    batch_times = np.array(batch_times)
+    return {"images_per_sec": FLAGS.steps * FLAGS.batch_size / batch_times.sum(),
+            "batch_ms_mean": 1000 * batch_times.mean(),
+            "batch_ms_p95": 1000 * np.percentile(batch_times, 95),
+            "peak_rss_mb": utils.peak_rss_mb()}
+
+
+def benchmark_stages(crop_image_size, resized_image_size):
+    """
+    Single threaded latency of each pipeline stage. Every stage gets its input fed from the previous stage's output,
+    so the numbers are isolated from each other (read, decode, crop, resize per image; batch per batch).
+    """
+    image_paths = celebA.read_dataset(FLAGS.data_dir).train_images[:FLAGS.decode_images]
+    top, left = celebA.CROP_OFFSET
+    path = tf.placeholder(tf.string, [])
+    read_op = tf.read_file(path)
+    value = tf.placeholder(tf.string, [])
+    decode_op = tf.image.decode_jpeg(value, channels=3)
+    decoded_image = tf.placeholder(tf.uint8, [None, None, 3])
+    crop_op = tf.image.crop_to_bounding_box(decoded_image, top, left, crop_image_size, crop_image_size)
+    cropped_image = tf.placeholder(tf.uint8, [crop_image_size, crop_image_size, 3])
+    resize_op = tf.saturate_cast(tf.round(tf.image.resize_bilinear(tf.expand_dims(tf.cast(cropped_image, tf.float32), 0),
+                                                                   [resized_image_size, resized_image_size])), tf.uint8)
+    examples = tf.placeholder(tf.uint8, [FLAGS.batch_size, resized_image_size, resized_image_size, 3])
+    batch_op = utils.process_image(tf.cast(examples, tf.float32), 127.5, 127.5)
+
+    stage_times = dict((stage, []) for stage in ("read", "decode", "crop", "resize", "batch"))
+
+    def timed(stage, fetch, feed_dict):
+        start_time = time.time()
+        output = sess.run(fetch, feed_dict=feed_dict)
+        stage_times[stage].append(time.time() - start_time)
+        return output
+
+    with tf.Session() as sess:
+        resized_images = []
+        for image_path in image_paths:
+            jpeg_value = timed("read", read_op, {path: image_path})
+            image = timed("decode", decode_op, {value: jpeg_value})
+            image = timed("crop", crop_op, {decoded_image: image})
+            resized_images.append(timed("resize", resize_op, {cropped_image: image})[0])
+        for start in range(0, len(resized_images) - FLAGS.batch_size + 1, FLAGS.batch_size):
+            timed("batch", batch_op, {examples: np.stack(resized_images[start:start + FLAGS.batch_size])})
+    return dict((stage + "_ms", 1000 * np.mean(times)) for stage, times in stage_times.items() if times)
+
+
+def benchmark_decode_modes(crop_image_size, resized_image_size):
+    """
+    Single threaded decode cost per image of each decode mode, and its deviation from the full decode output.
+    """
+    image_paths = celebA.read_dataset(FLAGS.data_dir).train_images[:FLAGS.decode_images]
+    jpeg_values = []
+    for image_path in image_paths:
+        with open(image_path, 'rb') as f:
+            jpeg_values.append(f.read())
+
+    results = {}
+    reference = None
+    for decode_mode in FLAGS.decode_modes.split(','):
+        tf.reset_default_graph()
+        model = GAN(100, crop_image_size, resized_image_size, FLAGS.batch_size, FLAGS.data_dir,
+                    input_backend="dataset", decode_mode=decode_mode)
+        jpeg_value = tf.placeholder(tf.string, [])
+        image = model._decode_image(jpeg_value)
+        with tf.Session() as sess:
+            images = []
+            start_time = time.time()
+            for value in jpeg_values:
+                images.append(sess.run(image, feed_dict={jpeg_value: value}))
+            duration = time.time() - start_time
+        images = np.stack(images).astype(np.float32)
+        if reference is None:
+            reference = images
+        error = np.abs(images - reference)
+        results[decode_mode] = {"ms_per_image": 1000.0 * duration / len(jpeg_values),
+                                "mean_abs_diff": float(error.mean()), "max_abs_diff": float(error.max())}
+    return results
+
+
+def compare_cache_pixels(crop_image_size, resized_image_size):
+    """
+    Deviation of the image cache preprocessing (celebA.preprocess_image) from the "full" decode of the queue backend
+    for the same images. Fails when the mean exceeds --max_cache_diff, if given.
+    """
+    image_paths = celebA.read_dataset(FLAGS.data_dir).train_images[:FLAGS.decode_images]
+    model = GAN(100, crop_image_size, resized_image_size, FLAGS.batch_size, FLAGS.data_dir,
+                input_backend="dataset", decode_mode="full")
+    jpeg_value = tf.placeholder(tf.string, [])
+    image = model._decode_image(jpeg_value)
+    errors = []
+    with tf.Session() as sess:
+        for image_path in image_paths:
+            with open(image_path, 'rb') as f:
+                reference = sess.run(image, feed_dict={jpeg_value: f.read()})
+            cached_image = celebA.preprocess_image(image_path, crop_image_size, [resized_image_size])[0]
+            errors.append(np.abs(cached_image.astype(np.float32) - reference))
+    errors = np.stack(errors)
+    result = {"mean_abs_diff": float(errors.mean()), "max_abs_diff": float(errors.max())}
+    if FLAGS.max_cache_diff and result["mean_abs_diff"] > FLAGS.max_cache_diff:
+        raise ValueError("Image cache pixels are %.3f levels off the queue backend on average (tolerance %.3f)" % (
+            result["mean_abs_diff"], FLAGS.max_cache_diff))
+    return result
+
+
+def main(argv=None):
+    crop_image_size, resized_image_size = map(int, FLAGS.image_size.split(','))
+    if FLAGS.synthetic_images:
+        width, height = map(int, FLAGS.synthetic_resolution.split('x'))
+        generate_synthetic_dataset(FLAGS.data_dir, FLAGS.synthetic_images, width=width, height=height)
+
+    report = {"version": utils.code_version(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "config": {"batch_size": FLAGS.batch_size, "image_size": FLAGS.image_size,
+                         "num_reader_threads": FLAGS.num_reader_threads, "decode_mode": FLAGS.decode_mode,
+                         "synthetic_images": FLAGS.synthetic_images, "cpu_count": multiprocessing.cpu_count()}}
+
+    report["stages"] = utils.run_isolated(benchmark_stages, crop_image_size, resized_image_size)
+    print("stages: " + ", ".join("%s %.3f ms" % item for item in sorted(report["stages"].items())))
+
+    if FLAGS.decode_modes:
+        report["decode_modes"] = utils.run_isolated(benchmark_decode_modes, crop_image_size, resized_image_size)
+        for decode_mode, result in sorted(report["decode_modes"].items()):
+            print("decode %-8s %8.3f ms/image  mean abs diff %6.3f  max abs diff %6.1f" % (
+                decode_mode, result["ms_per_image"], result["mean_abs_diff"], result["max_abs_diff"]))
+
+    if FLAGS.compare_cache:
+        report["cache_pixels"] = utils.run_isolated(compare_cache_pixels, crop_image_size, resized_image_size)
+        print("cache vs queue pixels: mean abs diff %.3f  max abs diff %.1f" % (
+            report["cache_pixels"]["mean_abs_diff"], report["cache_pixels"]["max_abs_diff"]))
+
+    backends = FLAGS.backends.split(',')
+    report["backends"] = {}
+    for backend in backends:
+        report["backends"][backend] = utils.run_isolated(benchmark_backend, backend, crop_image_size, resized_image_size)
+
+    baseline = report["backends"][backends[0]]["images_per_sec"]
+    for backend in backends:
+        result = report["backends"][backend]
+        print("%-8s %10.1f images/sec  (%.2fx vs %s)  batch %.2f ms (p95 %.2f)  peak RSS %.0f MB" % (
+            backend, result["images_per_sec"], result["images_per_sec"] / baseline, backends[0],
+            result["batch_ms_mean"], result["batch_ms_p95"], result["peak_rss_mb"]))
+
+    if FLAGS.json_output:
+        with open(FLAGS.json_output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print("Results written to %s" % FLAGS.json_output)
+
+
+if __name__ == "__main__":
+    tf.app.run()
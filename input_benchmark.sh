@@ -0,0 +1 @@
+python input_benchmark.py --data_dir=Data_zoo/synthetic_faces/ --synthetic_images=5000 --image_size=108,64 --backends=queue,cache,dataset,zip --json_output=logs/input_benchmark.json
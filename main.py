@@ -4,9 +4,17 @@ __author__ = "shekkizh"
 """
 Tensorflow implementation of Wasserstein GAN
 """
+import json
+import os
+import shutil
+import tempfile
+import time
 import numpy as np
 import tensorflow as tf
+import utils as utils
 from models.GAN_models import *
+from models.export import build_generator, export_generator
+import Dataset_Reader.read_celebADataset as celebA
 
 FLAGS = tf.flags.FLAGS
 tf.flags.DEFINE_integer("batch_size", "64", "batch size for training")
@@ -20,41 +28,257 @@ tf.flags.DEFINE_string("image_size", "108,64", "Size of actual images, Size of i
 tf.flags.DEFINE_integer("model", "0", "Model to train. 0 - GAN, 1 - WassersteinGAN")
 tf.flags.DEFINE_string("optimizer", "Adam", "Optimizer to use for training")
 tf.flags.DEFINE_integer("gen_dimension", "16", "dimension of first layer in generator")
-tf.flags.DEFINE_string("mode", "train", "train / visualize model")
+tf.flags.DEFINE_string("mode", "train", "train / visualize model / build - preprocess dataset into the image cache pyramid"
+                                        " / autotune - pick thread pool sizes and core affinity for training"
+                                        " / sample - write no_of_samples generated images to logs_dir/samples.npy"
+                                        " / export - write the generator of the logs_dir checkpoint to export_dir")
+tf.flags.DEFINE_string("export_dir", "", "generator-only export written by export mode, and loaded by visualize / "
+                                         "sample modes instead of the logs_dir checkpoint when set")
+tf.flags.DEFINE_integer("no_of_samples", "1000", "images generated in sample mode")
+tf.flags.DEFINE_integer("sample_batch_size", "0", "images generated per session run in sample mode (0 - batch_size)")
 tf.flags.DEFINE_integer("nr_iter_vis", 1000, "number of iterations during visualization")
 tf.flags.DEFINE_integer("nr_batches_tsne", 100, "number of batches to run for tsne visualization")
 tf.flags.DEFINE_bool("plot_iter_error", True, "plot the iterations error during visualization")
+tf.flags.DEFINE_string("input_backend", "queue",
+                       "queue - decode JPEGs every step / cache - memory-mapped uint8 cache / dataset - tf.data pipeline"
+                       " / zip - tf.data pipeline reading straight from img_align_celeba.zip")
+tf.flags.DEFINE_integer("num_workers", "0", "processes used by build mode (0 - all cores)")
+tf.flags.DEFINE_integer("num_reader_threads", "4", "(initial) number of JPEG reader threads for the queue backend")
+tf.flags.DEFINE_integer("queue_capacity", "0", "(initial) batch queue capacity in examples (0 - default)")
+tf.flags.DEFINE_bool("adaptive_readers", False, "grow/shrink reader threads and queue capacity to keep the queue fed")
+tf.flags.DEFINE_integer("shuffle_buffer", "10000", "examples in the shuffle buffer of the dataset backend")
+tf.flags.DEFINE_integer("prefetch_batches", "8", "batches prefetched by the dataset backend")
+tf.flags.DEFINE_string("decode_mode", "full", "full / crop - decode only the crop window / crop_dct - also DCT downscale")
+tf.flags.DEFINE_integer("seed", "0", "random seed of the in-graph z sampling and numpy (0 - unseeded)")
+tf.flags.DEFINE_string("summary_level", "scalars", "off / scalars / images / histograms - summaries built and written")
+tf.flags.DEFINE_string("summary_every", "100,500,2000", "steps between scalars, images and histograms summary writes")
+tf.flags.DEFINE_integer("checkpoint_every_steps", "0", "steps between checkpoints (0 - model default)")
+tf.flags.DEFINE_integer("checkpoint_every_secs", "0", "also checkpoint after this many seconds (0 - off)")
+tf.flags.DEFINE_integer("keep_checkpoints", "5", "most recent checkpoints kept (0 - all)")
+tf.flags.DEFINE_integer("keep_checkpoint_every", "0", "additionally keep every n-th checkpoint (0 - none)")
+tf.flags.DEFINE_integer("num_towers", "1", "training replicas the batch is split across, one per CPU device")
+tf.flags.DEFINE_string("job_name", "", "distributed training: ps / worker ('' - train locally)")
+tf.flags.DEFINE_integer("task_index", "0", "distributed training: index of this task within its job, worker 0 is chief")
+tf.flags.DEFINE_string("ps_hosts", "localhost:2222", "distributed training: comma separated parameter server host:port")
+tf.flags.DEFINE_string("worker_hosts", "localhost:2223,localhost:2224", "distributed training: comma separated worker host:port")
+tf.flags.DEFINE_integer("intra_op_threads", "0", "threads of a single op (0 - tuned value from logs_dir or TF default)")
+tf.flags.DEFINE_integer("inter_op_threads", "0", "ops run concurrently (0 - tuned value from logs_dir or TF default)")
+tf.flags.DEFINE_string("cpu_affinity", "", "cores to pin to, e.g. 0-15,32-47 ('' - tuned value from logs_dir or all)")
+tf.flags.DEFINE_integer("autotune_steps", "200", "training steps timed per session configuration in autotune mode")
+tf.flags.DEFINE_bool("xla", False, "JIT compile the generator and discriminator with XLA")
+tf.flags.DEFINE_bool("fused_critic", False, "WassersteinGAN: run the critic iterations in-graph, one session call per step")
+tf.flags.DEFINE_bool("fused_batch_norm", False,
+                     "fused batch norm kernels, checkpoints are compatible either way (not with --xla)")
+tf.flags.DEFINE_string("critic_pass", "separate",
+                       "separate / split / joint - critic forward passes over the real and fake batches, see CRITIC_PASSES")
 
 
-def main(argv=None):
+SESSION_CONFIG_FILENAME = "session_config.json"
+# Subgraphs each mode builds - "trains": the variables its train ops update, the only ones given optimizer slots
+# (None - the generator alone, no critic, optimizers or dataset), "real_critic": the critic also runs on real images,
+# so the dataset is read (iterator modes need it only when the generator loss uses real images), "summaries": summaries
+# are built and written
+MODE_GRAPHS = {"train": {"trains": "networks", "real_critic": True, "summaries": True},
+               "visualize": {"trains": None, "real_critic": False, "summaries": False},
+               "sample": {"trains": None, "real_critic": False, "summaries": False},
+               "export": {"trains": None, "real_critic": False, "summaries": False},
+               "image_iterator_visualize": {"trains": "image_iterator", "real_critic": False, "summaries": False},
+               "z_iterator_visualize": {"trains": "z_iterator", "real_critic": False, "summaries": False},
+               "z_iterator_tsne": {"trains": "z_iterator", "real_critic": False, "summaries": False}}
+
+
+def create_model(mode, crop_image_size, resized_image_size, device_setter=""):
     gen_dim = FLAGS.gen_dimension
     generator_dims = [64 * gen_dim, 64 * gen_dim // 2, 64 * gen_dim // 4, 64 * gen_dim // 8, 3]
     discriminator_dims = [3, 64, 64 * 2, 64 * 4, 64 * 8, 1]
 
-    crop_image_size, resized_image_size = map(int, FLAGS.image_size.split(','))
-    trainable_z = False
-    trainable_image = False
-    if FLAGS.mode in ("z_iterator_visualize", "z_iterator_tsne"):
-        trainable_z = True
-    if FLAGS.mode in ("image_iterator_visualize"):
-        trainable_image = True
+    if mode not in MODE_GRAPHS:
+        raise ValueError("Unknown mode %s" % mode)
+    graphs = MODE_GRAPHS[mode]
     if FLAGS.model == 0:
-        model = GAN(FLAGS.z_dim, crop_image_size, resized_image_size, FLAGS.batch_size, FLAGS.data_dir)
+        model_class, model_params = GAN, {}
     elif FLAGS.model == 1:
-        model = WasserstienGAN(FLAGS.z_dim, crop_image_size, resized_image_size, FLAGS.batch_size, FLAGS.data_dir,
-                               clip_values=(-0.01, 0.01), critic_iterations=5)
+        model_class, model_params = WasserstienGAN, dict(clip_values=(-0.01, 0.01), critic_iterations=5)
     else:
         raise ValueError("Unknown model identifier - FLAGS.model=%d" % FLAGS.model)
+    real_critic = graphs["real_critic"] or (graphs["trains"] is not None and
+                                            model_class.generator_loss_uses_real_images)
+
+    input_params = dict(input_backend=None)
+    if real_critic:
+        input_params = dict(input_backend=FLAGS.input_backend, num_reader_threads=FLAGS.num_reader_threads,
+                            queue_capacity=FLAGS.queue_capacity or None, adaptive_readers=FLAGS.adaptive_readers,
+                            shuffle_buffer=FLAGS.shuffle_buffer, prefetch_batches=FLAGS.prefetch_batches,
+                            decode_mode=FLAGS.decode_mode)
+    model_params.update(input_params)
+    with tf.device(device_setter):
+        model = model_class(FLAGS.z_dim, crop_image_size, resized_image_size, FLAGS.batch_size, FLAGS.data_dir,
+                            **model_params)
+        if graphs["trains"] is None:
+            model.create_inference_network(generator_dims, xla=FLAGS.xla, fused_batch_norm=FLAGS.fused_batch_norm)
+            return model
+
+        train_networks = graphs["trains"] == "networks"
+        model.create_network(generator_dims, discriminator_dims, FLAGS.optimizer, FLAGS.learning_rate,
+                             FLAGS.optimizer_param, trainable_z=graphs["trains"] == "z_iterator",
+                             trainable_image=graphs["trains"] == "image_iterator",
+                             fused_critic=FLAGS.fused_critic and train_networks,
+                             summary_level=FLAGS.summary_level if graphs["summaries"] else "off",
+                             summary_every=list(map(int, FLAGS.summary_every.split(','))),
+                             num_towers=FLAGS.num_towers if train_networks else 1, xla=FLAGS.xla,
+                             critic_pass=FLAGS.critic_pass,
+                             fused_batch_norm=FLAGS.fused_batch_norm, real_critic=real_critic)
+    return model
+
+
+def session_settings():
+    """
+    Thread pool sizes and core affinity - the flags where set, else the autotune result saved in logs_dir.
+    """
+    settings = {"intra_op_threads": 0, "inter_op_threads": 0, "cpu_affinity": None}
+    config_path = os.path.join(FLAGS.logs_dir, SESSION_CONFIG_FILENAME)
+    if os.path.exists(config_path):
+        with open(config_path) as f:
+            tuned = json.load(f)
+        print("Using tuned session config from %s" % config_path)
+        settings.update((key, tuned[key]) for key in list(settings))
+    if FLAGS.intra_op_threads:
+        settings["intra_op_threads"] = FLAGS.intra_op_threads
+    if FLAGS.inter_op_threads:
+        settings["inter_op_threads"] = FLAGS.inter_op_threads
+    if FLAGS.cpu_affinity:
+        settings["cpu_affinity"] = utils.parse_cpu_list(FLAGS.cpu_affinity)
+    return settings
+
+
+def tuning_candidates():
+    """
+    Affinity layouts (all cores, first half of the cores) crossed with intra-op pools sized to the layout, the layout
+    minus the reader threads and half the layout, and a few inter-op pool sizes.
+    """
+    cores = utils.available_cores()
+    layouts = [cores]
+    if len(cores) >= 4:
+        layouts.append(cores[:len(cores) // 2])
+    candidates = []
+    for layout in layouts:
+        no_of_cores = len(layout)
+        intra_op_sizes = sorted(set([no_of_cores, max(1, no_of_cores - FLAGS.num_reader_threads),
+                                     max(1, no_of_cores // 2)]))
+        for intra_op_threads in intra_op_sizes:
+            for inter_op_threads in (1, 2, 4):
+                candidates.append({"intra_op_threads": intra_op_threads, "inter_op_threads": inter_op_threads,
+                                   "cpu_affinity": layout})
+    return candidates
+
 
-    model.create_network(generator_dims, discriminator_dims, FLAGS.optimizer, FLAGS.learning_rate,
-                         FLAGS.optimizer_param, trainable_z=trainable_z, trainable_image=trainable_image)
+def time_training(settings, crop_image_size, resized_image_size):
+    utils.set_cpu_affinity(settings["cpu_affinity"])
+    model = create_model("train", crop_image_size, resized_image_size)
+    logs_dir = tempfile.mkdtemp() + "/"
+    try:
+        model.initialize_network(logs_dir, checkpointing=False, intra_op_threads=settings["intra_op_threads"],
+                                 inter_op_threads=settings["inter_op_threads"])
+        start_time = time.time()
+        model.train_model(FLAGS.autotune_steps + 1)
+        return FLAGS.autotune_steps / (time.time() - start_time)
+    finally:
+        shutil.rmtree(logs_dir)
+
+
+def autotune(crop_image_size, resized_image_size):
+    results = []
+    for settings in tuning_candidates():
+        steps_per_sec = utils.run_isolated(time_training, settings, crop_image_size, resized_image_size)
+        print("intra %d, inter %d, %d cores: %.2f steps/sec" % (settings["intra_op_threads"],
+                                                                 settings["inter_op_threads"],
+                                                                 len(settings["cpu_affinity"]), steps_per_sec))
+        results.append(dict(settings, steps_per_sec=steps_per_sec))
+    best = max(results, key=lambda result: result["steps_per_sec"])
+    best = dict(best, results=results, version=utils.code_version())
+    if not os.path.exists(FLAGS.logs_dir):
+        os.makedirs(FLAGS.logs_dir)
+    config_path = os.path.join(FLAGS.logs_dir, SESSION_CONFIG_FILENAME)
+    with open(config_path, 'w') as f:
+        json.dump(best, f, indent=2, sort_keys=True)
+    print("Best: intra %d, inter %d, cores %s - %.2f steps/sec, written to %s" % (
+        best["intra_op_threads"], best["inter_op_threads"], best["cpu_affinity"], best["steps_per_sec"], config_path))
+
+
+def main(argv=None):
+    crop_image_size, resized_image_size = map(int, FLAGS.image_size.split(','))
+    if FLAGS.mode == "build":
+        celebA.build(FLAGS.data_dir, crop_image_size, celebA.pyramid_sizes(crop_image_size, resized_image_size),
+                     num_workers=FLAGS.num_workers or None)
+        return
+    if FLAGS.mode == "autotune":
+        autotune(crop_image_size, resized_image_size)
+        return
+
+    settings = session_settings()
+    if settings["cpu_affinity"]:
+        # before the server or any reader or session thread is started, so they all inherit it
+        utils.set_cpu_affinity(settings["cpu_affinity"])
+
+    master = ""
+    device_setter = ""
+    if FLAGS.job_name:
+        ps_hosts = FLAGS.ps_hosts.split(',')
+        cluster = tf.train.ClusterSpec({"ps": ps_hosts, "worker": FLAGS.worker_hosts.split(',')})
+        server = tf.train.Server(cluster, job_name=FLAGS.job_name, task_index=FLAGS.task_index)
+        if FLAGS.job_name == "ps":
+            server.join()
+            return
+        master = server.target
+        # variables spread over the parameter servers by size, everything else runs on this worker
+        device_setter = tf.train.replica_device_setter(
+            worker_device="/job:worker/task:%d" % FLAGS.task_index, cluster=cluster,
+            ps_strategy=tf.contrib.training.GreedyLoadBalancingStrategy(len(ps_hosts),
+                                                                        tf.contrib.training.byte_size_load_fn))
+
+    if FLAGS.seed:
+        tf.set_random_seed(FLAGS.seed)
+        np.random.seed(FLAGS.seed)
+
+    if FLAGS.mode == "export" and not FLAGS.export_dir:
+        raise ValueError("export mode needs --export_dir")
+    start_time = time.time()
+    checkpoint_dir = None
+    if FLAGS.mode in ("visualize", "sample") and FLAGS.export_dir:
+        # the architecture comes from the export, not the model flags - and so does the batch size, unless given
+        batch_size = FLAGS.batch_size if FLAGS["batch_size"].present else None
+        model = build_generator(FLAGS.export_dir, batch_size=batch_size, xla=FLAGS.xla,
+                                fused_batch_norm=FLAGS.fused_batch_norm)
+        checkpoint_dir = FLAGS.export_dir
+    else:
+        model = create_model(FLAGS.mode, crop_image_size, resized_image_size, device_setter=device_setter)
+    build_time = time.time() - start_time
 
-    model.initialize_network(FLAGS.logs_dir)
+    # inference graphs get no summary writer to create it, but still write their output there
+    if not os.path.exists(FLAGS.logs_dir):
+        os.makedirs(FLAGS.logs_dir)
+    model.initialize_network(FLAGS.logs_dir, checkpointing=FLAGS.mode == "train",
+                             checkpoint_every_steps=FLAGS.checkpoint_every_steps or None,
+                             checkpoint_every_secs=FLAGS.checkpoint_every_secs or None,
+                             keep_checkpoints=FLAGS.keep_checkpoints, keep_checkpoint_every=FLAGS.keep_checkpoint_every,
+                             master=master, is_chief=FLAGS.task_index == 0,
+                             intra_op_threads=settings["intra_op_threads"],
+                             inter_op_threads=settings["inter_op_threads"], checkpoint_dir=checkpoint_dir)
+    variables = tf.global_variables() + tf.local_variables()
+    print("%s mode: graph built in %.2f sec, initialized in %.2f sec, %d variables (%.1f MB)" % (
+        FLAGS.mode, build_time, time.time() - start_time - build_time, len(variables),
+        utils.variables_size_mb(variables)))
 
     if FLAGS.mode == "train":
         model.train_model(int(1 + FLAGS.iterations))
     elif FLAGS.mode == "visualize":
         model.visualize_model()
+    elif FLAGS.mode == "export":
+        export_generator(model, FLAGS.export_dir)
+    elif FLAGS.mode == "sample":
+        samples = model.sample_images(FLAGS.no_of_samples, batch_size=FLAGS.sample_batch_size or None)
+        np.save(os.path.join(FLAGS.logs_dir, "samples.npy"), samples)
+        print("%d samples written to %s" % (len(samples), os.path.join(FLAGS.logs_dir, "samples.npy")))
     elif FLAGS.mode == "image_iterator_visualize":
         model.image_iterator_visualize_model(nr_iterations=FLAGS.nr_iter_vis, plot_iteration_error=FLAGS.plot_iter_error)
     elif FLAGS.mode == "z_iterator_visualize":
@@ -6,6 +6,7 @@ import tensorflow as tf
 import numpy as np
 import os, sys, inspect
 import time
+import contextlib
 
 utils_folder = os.path.realpath(
     os.path.abspath(os.path.join(os.path.split(inspect.getfile(inspect.currentframe()))[0], "..")))
@@ -14,21 +15,83 @@ if utils_folder not in sys.path:
 
 import utils as utils
 import Dataset_Reader.read_celebADataset as celebA
+from Dataset_Reader.input_pipeline import InputMonitor, ReaderPool
+from models.checkpointing import AsyncCheckpointer
+from models.metrics import RunningMetrics
 from six.moves import xrange
 from tqdm import *
 import matplotlib.pyplot as plt
-from sklearn import manifold
+
+# Each level adds its summaries on top of the previous ones and is written with its own cadence
+SUMMARY_LEVELS = ("off", "scalars", "images", "histograms")
+# How the critic sees the real and fake batches - two forward passes, or one pass over the concatenated batch whose
+# batch norm uses per-half ("split") or joint statistics
+CRITIC_PASSES = ("separate", "split", "joint")
 
 
 class GAN(object):
-    def __init__(self, z_dim, crop_image_size, resized_image_size, batch_size, data_dir):
-        celebA_dataset = celebA.read_dataset(data_dir)
+    checkpoint_every = 2000  # default checkpoint cadence in steps
+    xla = False
+    fused_batch_norm = False
+    generator_loss_uses_real_images = True  # feature matching of improved_gan_loss
+
+    def __init__(self, z_dim, crop_image_size, resized_image_size, batch_size, data_dir, input_backend="queue",
+                 num_reader_threads=4, queue_capacity=None, adaptive_readers=False, shuffle_buffer=10000,
+                 prefetch_batches=8, decode_mode="full"):
+        """
+        :param input_backend: None - no dataset and no input pipeline, for create_inference_network,
+        "queue" - decode JPEGs with TF reader threads every step,
+        "cache" - serve batches from the pre-decoded memory-mapped uint8 cache pyramid (built on first use),
+        "dataset" - tf.data pipeline with parallel file reads/decode, a shuffle buffer and batch prefetch,
+        "zip" - the dataset pipeline reading JPEG bytes by offset from the memory-mapped img_align_celeba.zip
+        :param num_reader_threads: (initial) number of decode threads feeding the batch queue / parallel
+        reads and decodes of the tf.data pipeline
+        :param queue_capacity: (initial) batch queue capacity in examples, None for the default
+        :param adaptive_readers: let a ReaderPool grow/shrink reader threads and queue capacity to keep the queue fed
+        :param shuffle_buffer: examples in the tf.data shuffle buffer
+        :param prefetch_batches: batches the tf.data pipeline prepares ahead of the train step
+        :param decode_mode: "full" - decode the whole frame then crop, "crop" - decode only the crop window,
+        "crop_dct" - decode only the crop window, downscaled in the DCT domain by the largest of 2/4/8 that keeps it
+        at least resized_image_size wide
+        """
         self.z_dim = z_dim
         self.crop_image_size = crop_image_size
         self.resized_image_size = resized_image_size
         self.batch_size = batch_size
-        filename_queue = tf.train.string_input_producer(celebA_dataset.train_images)
-        self.images = self._read_input_queue(filename_queue)
+        self.input_backend = input_backend
+        self.num_reader_threads = num_reader_threads
+        self.queue_capacity = queue_capacity
+        self.adaptive_readers = adaptive_readers
+        self.shuffle_buffer = shuffle_buffer
+        self.prefetch_batches = prefetch_batches
+        self.decode_mode = decode_mode
+        self.input_image_size = resized_image_size
+        self.decode_ratio = 1
+        if decode_mode == "crop_dct":
+            for ratio in (8, 4, 2):
+                if crop_image_size // ratio >= resized_image_size:
+                    self.decode_ratio = ratio
+                    break
+        elif decode_mode not in ("full", "crop"):
+            raise ValueError("Unknown decode mode %s" % decode_mode)
+        if input_backend is None:
+            self.images = None
+        elif input_backend == "queue":
+            celebA_dataset = celebA.read_dataset(data_dir)
+            filename_queue = tf.train.string_input_producer(celebA_dataset.train_images)
+            self.images = self._read_input_queue(filename_queue)
+        elif input_backend == "cache":
+            celebA_dataset = celebA.read_dataset(data_dir, image_cache_size=(crop_image_size, resized_image_size))
+            self.images = self._read_input_cache(celebA_dataset.train_image_cache)
+        elif input_backend == "dataset":
+            celebA_dataset = celebA.read_dataset(data_dir)
+            self.images = self._read_input_dataset(celebA_dataset.train_images)
+        elif input_backend == "zip":
+            celebA_dataset = celebA.read_zip_dataset(data_dir)
+            self.archive = celebA_dataset.archive
+            self.images = self._read_input_dataset(celebA_dataset.train_images, read_file=self._read_zip_member)
+        else:
+            raise ValueError("Unknown input backend %s" % input_backend)
 
     def _read_input(self, filename_queue):
         class DataRecord(object):
@@ -37,47 +100,131 @@ class GAN(object):
         reader = tf.WholeFileReader()
         key, value = reader.read(filename_queue)
         record = DataRecord()
-        decoded_image = tf.image.decode_jpeg(value,
-                                             channels=3)  # Assumption:Color images are read and are to be generated
+        record.input_image = self._decode_image(value)
+        return record
 
-        # decoded_image_4d = tf.expand_dims(decoded_image, 0)
-        # resized_image = tf.image.resize_bilinear(decoded_image_4d, [self.target_image_size, self.target_image_size])
-        # record.input_image = tf.squeeze(resized_image, squeeze_dims=[0])
+    def _decode_image(self, value):
+        top, left = celebA.CROP_OFFSET
+        if self.decode_mode == "full":
+            decoded_image = tf.image.decode_jpeg(value,
+                                                 channels=3)  # Assumption:Color images are read and are to be generated
 
-        cropped_image = tf.cast(
-            tf.image.crop_to_bounding_box(decoded_image, 55, 35, self.crop_image_size, self.crop_image_size),
-            tf.float32)
+            # decoded_image_4d = tf.expand_dims(decoded_image, 0)
+            # resized_image = tf.image.resize_bilinear(decoded_image_4d, [self.target_image_size, self.target_image_size])
+            # record.input_image = tf.squeeze(resized_image, squeeze_dims=[0])
+
+            cropped_image = tf.image.crop_to_bounding_box(decoded_image, top, left, self.crop_image_size,
+                                                          self.crop_image_size)
+        else:
+            # libjpeg applies the crop window after DCT scaling, so the window is given in scaled coordinates
+            ratio = self.decode_ratio
+            crop_size = self.crop_image_size // ratio
+            cropped_image = tf.image.decode_and_crop_jpeg(value, [top // ratio, left // ratio, crop_size, crop_size],
+                                                          channels=3, ratio=ratio)
+            cropped_image.set_shape([crop_size, crop_size, 3])
+        cropped_image = tf.cast(cropped_image, tf.float32)
         decoded_image_4d = tf.expand_dims(cropped_image, 0)
         resized_image = tf.image.resize_bilinear(decoded_image_4d, [self.resized_image_size, self.resized_image_size])
-        record.input_image = tf.squeeze(resized_image, axis=[0])
-        return record
+        # Queues and prefetch buffers carry uint8, the float conversion happens on the dequeued batch
+        return tf.saturate_cast(tf.round(tf.squeeze(resized_image, axis=[0])), tf.uint8)
 
     def _read_input_queue(self, filename_queue):
         print("Setting up image reader...")
         read_input = self._read_input(filename_queue)
-        num_preprocess_threads = 4
-        num_examples_per_epoch = 800
-        min_queue_examples = int(0.1 * num_examples_per_epoch)
+        if self.queue_capacity is None:
+            num_examples_per_epoch = 800
+            min_queue_examples = int(0.1 * num_examples_per_epoch)
+            # 4x the float32 era capacity - uint8 examples keep the same memory footprint
+            self.queue_capacity = 4 * (min_queue_examples + 2 * self.batch_size)
+        # In adaptive mode the queue gets headroom and the ReaderPool enforces a soft capacity below it
+        self.max_queue_capacity = 4 * self.queue_capacity if self.adaptive_readers else self.queue_capacity
         print("Shuffling")
-        input_image = tf.train.batch([read_input.input_image],
-                                     batch_size=self.batch_size,
-                                     num_threads=num_preprocess_threads,
-                                     capacity=min_queue_examples + 2 * self.batch_size
-                                     )
-        input_image = utils.process_image(input_image, 127.5, 127.5)
+        with tf.name_scope("input"):
+            input_queue = tf.FIFOQueue(self.max_queue_capacity, [tf.uint8],
+                                       shapes=[[self.resized_image_size, self.resized_image_size, 3]],
+                                       name="batch_queue")
+            # per worker - next to its queue rather than on a parameter server, and initialized by every worker
+            with tf.colocate_with(input_queue.queue_ref):
+                self.examples_decoded = tf.Variable(0, dtype=tf.int64, trainable=False, name="examples_decoded",
+                                                    collections=[tf.GraphKeys.LOCAL_VARIABLES])
+            enqueue_op = input_queue.enqueue([read_input.input_image])
+            with tf.control_dependencies([enqueue_op]):
+                self.input_enqueue_op = tf.assign_add(self.examples_decoded, 1, use_locking=True).op
+            self.input_close_op = input_queue.close(cancel_pending_enqueues=True)
+            self.input_queue_size = input_queue.size()
+            self.input_queue = input_queue
+            input_image = self._dequeue_input()
+        self.input_dequeue_name = input_image.op.name
+        if not self.adaptive_readers:
+            tf.train.add_queue_runner(tf.train.QueueRunner(input_queue,
+                                                           [self.input_enqueue_op] * self.num_reader_threads))
+        return self._process_batch(input_image)
+
+    def _read_zip_member(self, position):
+        value = tf.py_func(self.archive.read, [position], tf.string, stateful=False, name="zip_member")
+        value.set_shape([])
+        return value
+
+    def _read_input_dataset(self, sources, read_file=tf.read_file):
+        """
+        :param sources: file paths, or whatever read_file maps to the JPEG bytes of one image
+        """
+        print("Setting up tf.data image reader...")
+        dataset = tf.data.Dataset.from_tensor_slices(tf.constant(sources))
+        dataset = dataset.shuffle(len(sources), reshuffle_each_iteration=True).repeat()
+        dataset = dataset.apply(tf.contrib.data.parallel_interleave(
+            lambda source: tf.data.Dataset.from_tensors(read_file(source)),
+            cycle_length=self.num_reader_threads, sloppy=True))
+        dataset = dataset.map(self._decode_image, num_parallel_calls=self.num_reader_threads)
+        dataset = dataset.shuffle(self.shuffle_buffer)
+        dataset = dataset.batch(self.batch_size)
+        dataset = dataset.prefetch(self.prefetch_batches)
+        self.input_iterator = dataset.make_one_shot_iterator()
+        return self._next_batch()
+
+    def _read_input_cache(self, image_cache):
+        print("Setting up cached image reader...")
+        self.cache_sampler = celebA.ImageCacheSampler(image_cache, self.batch_size)
+        self.input_image_size = image_cache.shape[1]
+        return self._next_batch()
+
+    def _dequeue_input(self):
+        """
+        A fresh uint8 batch op of the configured input backend - every call builds a separate dequeue.
+        """
+        if self.input_backend == "queue":
+            input_image = self.input_queue.dequeue_many(self.batch_size, name="dequeue")
+        elif self.input_backend == "cache":
+            input_image = tf.py_func(self.cache_sampler, [], tf.uint8, stateful=True, name="cached_images")
+        else:
+            input_image = self.input_iterator.get_next(name="input_batch")
+        input_image.set_shape([self.batch_size, self.input_image_size, self.input_image_size, 3])
         return input_image
 
-    def _generator(self, z, dims, train_phase, activation=tf.nn.relu, scope_name="generator"):
+    def _process_batch(self, input_image):
+        input_image = tf.cast(input_image, tf.float32)
+        if self.input_image_size != self.resized_image_size:
+            # nearest larger pyramid level of the image cache
+            input_image = tf.image.resize_bilinear(input_image, [self.resized_image_size, self.resized_image_size])
+        return utils.process_image(input_image, 127.5, 127.5)
+
+    def _next_batch(self):
+        return self._process_batch(self._dequeue_input())
+
+    def _generator(self, z, dims, train_phase, activation=tf.nn.relu, scope_name="generator", scope_reuse=False):
         N = len(dims)
         image_size = self.resized_image_size // (2 ** (N - 1))
-        with tf.variable_scope(scope_name) as scope:
+        with tf.variable_scope(scope_name) as scope, utils.jit_scope(self.xla):
+            if scope_reuse:
+                scope.reuse_variables()
             W_z = utils.weight_variable([self.z_dim, dims[0] * image_size * image_size], name="W_z")
             b_z = utils.bias_variable([dims[0] * image_size * image_size], name="b_z")
             h_z = tf.matmul(z, W_z) + b_z
             h_z = tf.reshape(h_z, [-1, image_size, image_size, dims[0]])
-            h_bnz = utils.batch_norm(h_z, dims[0], train_phase, scope="gen_bnz")
+            h_bnz = utils.batch_norm(h_z, dims[0], train_phase, scope="gen_bnz",
+                                     fused=self.fused_batch_norm)
             h = activation(h_bnz, name='h_z')
-            utils.add_activation_summary(h)
+            self._activation_summary(h)
 
             for index in range(N - 2):
                 image_size *= 2
@@ -85,9 +232,10 @@ class GAN(object):
                 b = utils.bias_variable([dims[index + 1]], name="b_%d" % index)
                 deconv_shape = tf.stack([tf.shape(h)[0], image_size, image_size, dims[index + 1]])
                 h_conv_t = utils.conv2d_transpose_strided(h, W, b, output_shape=deconv_shape)
-                h_bn = utils.batch_norm(h_conv_t, dims[index + 1], train_phase, scope="gen_bn%d" % index)
+                h_bn = utils.batch_norm(h_conv_t, dims[index + 1], train_phase, scope="gen_bn%d" % index,
+                                        fused=self.fused_batch_norm)
                 h = activation(h_bn, name='h_%d' % index)
-                utils.add_activation_summary(h)
+                self._activation_summary(h)
 
             image_size *= 2
             W_pred = utils.weight_variable([5, 5, dims[-1], dims[-2]], name="W_pred")
@@ -95,14 +243,14 @@ class GAN(object):
             deconv_shape = tf.stack([tf.shape(h)[0], image_size, image_size, dims[-1]])
             h_conv_t = utils.conv2d_transpose_strided(h, W_pred, b_pred, output_shape=deconv_shape)
             pred_image = tf.nn.tanh(h_conv_t, name='pred_image')
-            utils.add_activation_summary(pred_image)
+            self._activation_summary(pred_image)
 
         return pred_image
 
     def _discriminator(self, input_images, dims, train_phase, activation=tf.nn.relu, scope_name="discriminator",
-                       scope_reuse=False):
+                       scope_reuse=False, bn_splits=1):
         N = len(dims)
-        with tf.variable_scope(scope_name) as scope:
+        with tf.variable_scope(scope_name) as scope, utils.jit_scope(self.xla):
             if scope_reuse:
                 scope.reuse_variables()
             h = input_images
@@ -115,22 +263,83 @@ class GAN(object):
                     h_bn = h_conv
                     skip_bn = False
                 else:
-                    h_bn = utils.batch_norm(h_conv, dims[index + 1], train_phase, scope="disc_bn%d" % index)
+                    h_bn = utils.batch_norm(h_conv, dims[index + 1], train_phase, scope="disc_bn%d" % index,
+                                            num_splits=bn_splits, fused=self.fused_batch_norm)
                 h = activation(h_bn, name="h_%d" % index)
-                utils.add_activation_summary(h)
+                self._activation_summary(h)
 
             shape = h.get_shape().as_list()
             image_size = self.resized_image_size // (2 ** (N - 2))  # dims has input dim and output dim
-            h_reshaped = tf.reshape(h, [self.batch_size, image_size * image_size * shape[3]])
+            h_reshaped = tf.reshape(h, [-1, image_size * image_size * shape[3]])
             W_pred = utils.weight_variable([image_size * image_size * shape[3], dims[-1]], name="W_pred")
             b_pred = utils.bias_variable([dims[-1]], name="b_pred")
             h_pred = tf.matmul(h_reshaped, W_pred) + b_pred
 
         return tf.nn.sigmoid(h_pred), h_pred, h
 
+    def _critic(self, real_images, fake_images, train_phase, scope_reuse=True, update_ops=None):
+        """
+        Discriminator logits and features of the real and the fake images, see CRITIC_PASSES
+        :param update_ops: dict whose "real" and "fake" lists get the batch norm updates of the passes the real and the
+        fake images go through (the same single pass outside "separate")
+        :return: logits_real, logits_fake, feature_real, feature_fake
+        """
+        if update_ops is None:
+            update_ops = {}
+        real_update_ops = update_ops.setdefault("real", [])
+        fake_update_ops = update_ops.setdefault("fake", [])
+        if self.critic_pass == "separate":
+            with self._collect_update_ops(real_update_ops):
+                _, logits_real, feature_real = self._discriminator(real_images, self.discriminator_dims, train_phase,
+                                                                   activation=self.discriminator_activation,
+                                                                   scope_name="discriminator", scope_reuse=scope_reuse)
+            with self._collect_update_ops(fake_update_ops):
+                _, logits_fake, feature_fake = self._discriminator(fake_images, self.discriminator_dims, train_phase,
+                                                                   activation=self.discriminator_activation,
+                                                                   scope_name="discriminator", scope_reuse=True)
+            return logits_real, logits_fake, feature_real, feature_fake
+
+        with self._collect_update_ops(real_update_ops):
+            _, logits, features = self._discriminator(tf.concat([real_images, fake_images], 0),
+                                                      self.discriminator_dims, train_phase,
+                                                      activation=self.discriminator_activation,
+                                                      scope_name="discriminator", scope_reuse=scope_reuse,
+                                                      bn_splits=2 if self.critic_pass == "split" else 1)
+        fake_update_ops.extend(real_update_ops)
+        no_of_real = tf.shape(real_images)[0]
+        if features is None:
+            return logits[:no_of_real], logits[no_of_real:], None, None
+        return logits[:no_of_real], logits[no_of_real:], features[:no_of_real], features[no_of_real:]
+
+    def _fake_critic(self, fake_images, train_phase):
+        """
+        Discriminator logits of the fake images alone, built under the name scope of the pass on fake images in
+        _critic so that it restores that pass's batch norm moving averages - the second, reused copy
+        (discriminator_1) in "separate", the single pass of both batches otherwise.
+        """
+        if self.critic_pass == "separate":
+            # take the name scope of the pass on real images
+            with tf.name_scope("discriminator"):
+                pass
+        _, logits_fake, _ = self._discriminator(fake_images, self.discriminator_dims, train_phase,
+                                                activation=self.discriminator_activation, scope_name="discriminator")
+        return logits_fake
+
+    @contextlib.contextmanager
+    def _collect_update_ops(self, update_ops):
+        """
+        Appends the batch norm moving average updates (tf.GraphKeys.UPDATE_OPS) created inside to update_ops
+        """
+        start = len(tf.get_collection(tf.GraphKeys.UPDATE_OPS))
+        yield
+        update_ops.extend(tf.get_collection(tf.GraphKeys.UPDATE_OPS)[start:])
+
+    def _leaky_relu(self, x, name="leaky_relu"):
+        return utils.leaky_relu(x, alpha=0.2, name=name)
+
     def _cross_entropy_loss(self, logits, labels, name="x_entropy"):
         xentropy = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(logits=logits, labels=labels))
-        tf.summary.scalar(name, xentropy)
+        self._scalar_summary(name, xentropy)
         return xentropy
 
     def _get_optimizer(self, optimizer_name, learning_rate, optimizer_param):
@@ -142,19 +351,88 @@ class GAN(object):
         else:
             raise ValueError("Unknown optimizer %s" % optimizer_name)
 
-    def _train(self, loss_val, var_list, optimizer):
+    def _train(self, loss_val, var_list, optimizer, update_ops=()):
+        """
+        :param loss_val: loss, or list of per-tower losses whose gradients are averaged
+        :param update_ops: ops run with every step - the batch norm moving average updates
+        """
         print("train variables are")
         for v in var_list:
             print (v.op.name)
 
-        grads = optimizer.compute_gradients(loss_val, var_list=var_list)
+        if isinstance(loss_val, list):
+            grads = self._average_gradients([optimizer.compute_gradients(loss, var_list=var_list,
+                                                                         colocate_gradients_with_ops=True)
+                                             for loss in loss_val])
+        else:
+            grads = optimizer.compute_gradients(loss_val, var_list=var_list)
         for grad, var in grads:
-            utils.add_gradient_summary(grad, var)
-        return optimizer.apply_gradients(grads)
+            self._gradient_summary(grad, var)
+        with tf.control_dependencies(update_ops):
+            return optimizer.apply_gradients(grads)
+
+    def _average_gradients(self, tower_grads):
+        average_grads = []
+        for grad_and_vars in zip(*tower_grads):
+            var = grad_and_vars[0][1]
+            grads = [grad for grad, _ in grad_and_vars if grad is not None]
+            if not grads:
+                average_grads.append((None, var))
+                continue
+            with tf.name_scope(var.op.name + "_average_gradient"):
+                average_grads.append((tf.add_n(grads) / len(grads), var))
+        return average_grads
+
+    def _tower_losses(self, tower, images, z, use_features):
+        """
+        Losses of training tower 1, 2, ... - a replica of the tower 0 network on its own device and shard of the batch.
+        Its batch norm uses batch statistics only, the moving averages are those updated by tower 0.
+        """
+        losses = (self.discriminator_loss, self.gen_loss, getattr(self, "gen_loss_full", None))
+        summary_level, self.summary_level = self.summary_level, "off"
+        with tf.device("/cpu:%d" % tower), tf.name_scope("tower_%d" % tower):
+            gen_images = self._generator(z, self.generator_dims, True, scope_name="generator", scope_reuse=True)
+            logits_real, logits_fake, feature_real, feature_fake = self._critic(images, gen_images, True)
+            self._gan_loss(logits_real, logits_fake, feature_real, feature_fake, use_features=use_features)
+        tower_losses = self.discriminator_loss, self.gen_loss
+        self.discriminator_loss, self.gen_loss, self.gen_loss_full = losses
+        self.summary_level = summary_level
+        return tower_losses
+
+    def _summary_enabled(self, level):
+        return SUMMARY_LEVELS.index(self.summary_level) >= SUMMARY_LEVELS.index(level)
+
+    def _summary_collections(self, level):
+        return ["summaries_" + level]
+
+    def _scalar_summary(self, name, tensor):
+        # scalars are fetched with the train ops and averaged by RunningMetrics, not run as summary ops
+        if self._summary_enabled("scalars"):
+            self.scalar_metrics[name] = tensor
+
+    def _image_summary(self, name, tensor):
+        if self._summary_enabled("images"):
+            tf.summary.image(name, tensor, collections=self._summary_collections("images"))
+
+    def _histogram_summary(self, name, tensor):
+        if self._summary_enabled("histograms"):
+            tf.summary.histogram(name, tensor, collections=self._summary_collections("histograms"))
+
+    def _activation_summary(self, var):
+        if self._summary_enabled("histograms"):
+            utils.add_activation_summary(var, collections=self._summary_collections("histograms"))
+
+    def _gradient_summary(self, grad, var):
+        if self._summary_enabled("histograms"):
+            utils.add_gradient_summary(grad, var, collections=self._summary_collections("histograms"))
 
     def _setup_placeholder(self):
         self.train_phase = tf.placeholder(tf.bool)
-        self.z_vec = tf.placeholder(tf.float32, [self.batch_size, self.z_dim], name="z")
+        # z is drawn in-graph on every run, feeding z_vec (of any batch size) overrides it
+        self.z_vec = tf.placeholder_with_default(self._sample_z(), [None, self.z_dim], name="z")
+
+    def _sample_z(self):
+        return tf.random_uniform([self.batch_size, self.z_dim], -1.0, 1.0, name="z_sample")
 
     def _gan_loss(self, logits_real, logits_fake, feature_real, feature_fake, use_features=False):
         discriminator_loss_real = self._cross_entropy_loss(logits_real, tf.ones_like(logits_real),
@@ -171,33 +449,90 @@ class GAN(object):
             gen_loss_features = 0
         self.gen_loss = gen_loss_disc + 0.1 * gen_loss_features
 
-        tf.summary.scalar("Discriminator_loss", self.discriminator_loss)
-        tf.summary.scalar("Generator_loss", self.gen_loss)
+    def _generator_loss(self, logits_fake, use_features=False):
+        """
+        gen_loss from the critic on the generated images alone
+        """
+        if use_features:
+            raise ValueError("The feature matching generator loss needs the critic on real images")
+        self.gen_loss = self._cross_entropy_loss(logits_fake, tf.ones_like(logits_fake), name="gen_disc_loss")
 
     def create_network(self, generator_dims, discriminator_dims, optimizer="Adam", learning_rate=2e-4,
-                       optimizer_param=0.9, improved_gan_loss=True, trainable_z=False, trainable_image=False):
+                       optimizer_param=0.9, improved_gan_loss=True, trainable_z=False, trainable_image=False,
+                       fused_critic=False, summary_level="scalars", summary_every=(100, 500, 2000), num_towers=1,
+                       xla=False, critic_pass="separate", fused_batch_norm=False, real_critic=True):
+        """
+        :param fused_critic: also build fused_train_op, a whole training iteration in one session call (WGAN only)
+        :param summary_level: one of SUMMARY_LEVELS, summaries above it are not built
+        :param summary_every: steps between writes of the scalars (also the log cadence), images and histograms
+        :param num_towers: split each training batch across this many network replicas on CPU devices
+        :param xla: JIT compile the generator and discriminator with XLA, not combinable with fused_batch_norm
+        :param critic_pass: one of CRITIC_PASSES, scoring with "split" needs as many real_images as z_vec fed
+        :param fused_batch_norm: use utils.fused_batch_norm, checkpoints are interchangeable with the default
+        :param real_critic: also run the critic on real images - without it only gen_loss is built (iterator modes)
+        """
         print("Setting up model...")
-        self._setup_placeholder()
-        tf.summary.histogram("z", self.z_vec)
+        if summary_level not in SUMMARY_LEVELS:
+            raise ValueError("Unknown summary level %s" % summary_level)
+        if critic_pass not in CRITIC_PASSES:
+            raise ValueError("Unknown critic pass %s" % critic_pass)
+        summary_every = list(summary_every)
+        if len(summary_every) != len(SUMMARY_LEVELS) - 1:
+            raise ValueError("summary_every needs one interval per summary level %s, got %s" % (
+                SUMMARY_LEVELS[1:], summary_every))
+        if num_towers > 1:
+            if self.batch_size % num_towers != 0:
+                raise ValueError("Batch size %d does not split across %d towers" % (self.batch_size, num_towers))
+            if trainable_z or trainable_image or fused_critic:
+                raise ValueError("Multi-tower training does not support iterator or fused critic training")
+        if not real_critic and not (trainable_z or trainable_image):
+            raise ValueError("Training the generator and discriminator needs the critic on real images")
+        if real_critic and self.images is None:
+            raise ValueError("The critic on real images needs an input pipeline")
+        self._setup_network(generator_dims, discriminator_dims, num_towers, xla, critic_pass, fused_batch_norm,
+                            summary_level)
+        self.fused_critic = fused_critic
+        self.summary_every = dict(zip(SUMMARY_LEVELS[1:], summary_every))
+        self._histogram_summary("z", self.z_vec)
+        if self.input_backend == "queue":
+            self._scalar_summary("input/fraction_of_%d_full" % self.max_queue_capacity,
+                                 tf.cast(self.input_queue_size, tf.float32) / self.max_queue_capacity)
 
         if trainable_z:
-            # make z iterator variable
-            self.z_iterator = tf.Variable(np.random.uniform(-1.0, 1.0, (self.batch_size, int(self.z_vec.get_shape()[1]))).astype(dtype=np.float32), name="z_iterator")
-            self.init_z_iterator = tf.group(self.z_iterator.assign(self.z_vec))
+            # make z iterator variable - takes the batch size of the z it is initialized from
+            self.z_iterator = tf.Variable(tf.random_uniform(tf.shape(self.z_vec), -1.0, 1.0), validate_shape=False,
+                                          name="z_iterator")
+            self.init_z_iterator = tf.assign(self.z_iterator, self.z_vec, validate_shape=False)
             self.z_iterator_min_max = tf.maximum(tf.minimum(tf.maximum(self.z_iterator, -1.0), 1.0), -1.0)
+            self.z_iterator_min_max.set_shape([None, self.z_dim])
             self.z_vec_in = self.z_iterator_min_max
         else:
             self.z_vec_in = self.z_vec
 
+        z_vec_in = self.z_vec_in
+        if real_critic:
+            # real images of any batch size can be fed for scoring
+            self.real_images = tf.placeholder_with_default(
+                self.images, [None, self.resized_image_size, self.resized_image_size, 3], name="real_images")
+            real_images = self.real_images
+        if num_towers > 1:
+            image_shards = tf.split(self.real_images, num_towers)
+            z_shards = tf.split(self.z_vec_in, num_towers)
+            real_images, z_vec_in = image_shards[0], z_shards[0]
 
         # generator for training
-        self.gen_images = self._generator(self.z_vec_in, generator_dims, self.train_phase, scope_name="generator")
+        generator_update_ops = []
+        with self._collect_update_ops(generator_update_ops):
+            self.gen_images = self._generator(z_vec_in, generator_dims, self.train_phase, scope_name="generator")
 
         if trainable_image:
-            # make image iterator variable
-            self.image_iterator = tf.Variable(np.random.uniform(0.0, 1.0, (self.batch_size,64,64,3)).astype(dtype=np.float32), name="image_iterator") 
-            self.init_image_iterator = tf.group(self.image_iterator.assign(self.gen_images))
+            # make image iterator variable - takes the batch size of the images it is initialized from
+            image_shape = [self.resized_image_size, self.resized_image_size, 3]
+            self.image_iterator = tf.Variable(tf.random_uniform(tf.concat([tf.shape(self.z_vec)[:1], image_shape], 0),
+                                                                0.0, 1.0), validate_shape=False, name="image_iterator")
+            self.init_image_iterator = tf.assign(self.image_iterator, self.gen_images, validate_shape=False)
             self.image_iterator_min_max = tf.minimum(tf.maximum(self.image_iterator, -1.0), 1.0)
+            self.image_iterator_min_max.set_shape([None] + image_shape)
             self.gen_images_out = self.image_iterator_min_max
         else:
             self.gen_images_out = self.gen_images
@@ -205,98 +540,291 @@ class GAN(object):
 
         # generator for z iterator
 
-        tf.summary.image("image_real", self.images)
-        tf.summary.image("image_generated", self.gen_images_out)
-
-        def leaky_relu(x, name="leaky_relu"):
-            return utils.leaky_relu(x, alpha=0.2, name=name)
+        if real_critic:
+            self._image_summary("image_real", self.images)
+        self._image_summary("image_generated", self.gen_images_out)
 
-        discriminator_real_prob, logits_real, feature_real = self._discriminator(self.images, discriminator_dims,
-                                                                                 self.train_phase,
-                                                                                 activation=leaky_relu,
-                                                                                 scope_name="discriminator",
-                                                                                 scope_reuse=False)
+        self.discriminator_activation = self._leaky_relu
 
-        discriminator_fake_prob, logits_fake, feature_fake = self._discriminator(self.gen_images_out, discriminator_dims,
-                                                                                 self.train_phase,
-                                                                                 activation=leaky_relu,
-                                                                                 scope_name="discriminator",
-                                                                                 scope_reuse=True)
+        if not real_critic:
+            logits_fake = self._fake_critic(self.gen_images_out, self.train_phase)
+            self._generator_loss(logits_fake, use_features=improved_gan_loss and self.generator_loss_uses_real_images)
+            self._create_iterator_train_ops(optimizer, learning_rate, optimizer_param, trainable_z, trainable_image)
+            return
 
-        # utils.add_activation_summary(tf.identity(discriminator_real_prob, name='disc_real_prob'))
-        # utils.add_activation_summary(tf.identity(discriminator_fake_prob, name='disc_fake_prob'))
+        critic_update_ops = {}
+        logits_real, logits_fake, feature_real, feature_fake = self._critic(real_images, self.gen_images_out,
+                                                                            self.train_phase, scope_reuse=False,
+                                                                            update_ops=critic_update_ops)
+        self.logits_real = logits_real
 
         # Loss calculation
         self._gan_loss(logits_real, logits_fake, feature_real, feature_fake, use_features=improved_gan_loss)
 
+        tower_losses = [(self.discriminator_loss, self.gen_loss)]
+        for tower in range(1, num_towers):
+            tower_losses.append(self._tower_losses(tower, image_shards[tower], z_shards[tower], improved_gan_loss))
+        if num_towers > 1:
+            discriminator_losses, gen_losses = map(list, zip(*tower_losses))
+            self.discriminator_loss = tf.add_n(discriminator_losses) / num_towers
+            self.gen_loss = tf.add_n(gen_losses) / num_towers
+        else:
+            discriminator_losses, gen_losses = self.discriminator_loss, self.gen_loss
+
         train_variables = tf.trainable_variables()
 
         for v in train_variables:
-            utils.add_to_regularization_and_summary(var=v)
+            self._histogram_summary(v.op.name, v)
 
         # get variable lists for everything
         self.generator_variables = [v for v in train_variables if v.name.startswith("generator")]
         self.discriminator_variables = [v for v in train_variables if v.name.startswith("discriminator")]
-        self.image_iterator_variables = [v for v in train_variables if v.name.startswith("image_iterator")]
-        self.z_iterator_variables = [v for v in train_variables if v.name.startswith("z_iterator")]
+
+        if trainable_image or trainable_z:
+            self._create_iterator_train_ops(optimizer, learning_rate, optimizer_param, trainable_z, trainable_image)
+            return
 
         # set optimizer
         optim = self._get_optimizer(optimizer, learning_rate, optimizer_param)
-        optim_z = self._get_optimizer(optimizer, learning_rate*10.0, optimizer_param)
 
         # make train ops
-        if not trainable_image and not trainable_z:
-          self.generator_train_op = self._train(self.gen_loss, self.generator_variables, optim)
-          self.discriminator_train_op = self._train(self.discriminator_loss, self.discriminator_variables, optim)
+        # each train op runs the batch norm updates of the forward passes its loss goes through - the generator step
+        # does not touch the critic pass on real images, so it does not dequeue a real batch either
+        generator_step_update_ops = generator_update_ops + critic_update_ops["fake"]
+        real_update_ops = [op for op in critic_update_ops["real"] if op not in critic_update_ops["fake"]]
+        discriminator_step_update_ops = generator_step_update_ops + real_update_ops
+        self.generator_train_op = self._train(gen_losses, self.generator_variables, optim, generator_step_update_ops)
+        self.discriminator_train_op = self._train(discriminator_losses, self.discriminator_variables, optim,
+                                                  discriminator_step_update_ops)
+        if fused_critic:
+            self._create_fused_train_ops(optim, real_update_ops)
+
+    def _create_iterator_train_ops(self, optimizer, learning_rate, optimizer_param, trainable_z, trainable_image):
+        """
+        Train ops of the image / z iterators on gen_loss. Only the optimizer of the iterator is created, so the
+        iterator is the only variable with optimizer slots.
+        """
+        train_variables = tf.trainable_variables()
+        self.image_iterator_variables = [v for v in train_variables if v.name.startswith("image_iterator")]
+        self.z_iterator_variables = [v for v in train_variables if v.name.startswith("z_iterator")]
         if trainable_image:
-          self.image_iterator_train_op = self._train(self.gen_loss, self.image_iterator_variables, optim)
+            optim = self._get_optimizer(optimizer, learning_rate, optimizer_param)
+            self.image_iterator_train_op = self._train(self.gen_loss, self.image_iterator_variables, optim)
+            self.reset_image_iterator_slots = self._slot_initializer(self.image_iterator, optim)
         if trainable_z:
-          self.z_iterator_train_op = self._train(self.gen_loss, self.z_iterator_variables, optim_z)
+            optim_z = self._get_optimizer(optimizer, learning_rate * 10.0, optimizer_param)
+            self.z_iterator_train_op = self._train(self.gen_loss, self.z_iterator_variables, optim_z)
+            self.reset_z_iterator_slots = self._slot_initializer(self.z_iterator, optim_z)
+
+    def create_inference_network(self, generator_dims, xla=False, fused_batch_norm=False):
+        """
+        Builds the sampling graph only - the generator on z_vec. No input pipeline, critic, losses, summaries or
+        optimizers, so it works with input_backend None. Follow with initialize_network(logs_dir, checkpointing=False).
+        """
+        print("Setting up inference model...")
+        self._setup_network(generator_dims, None, 1, xla, "separate", fused_batch_norm, "off")
+        self.gen_images = self._generator(self.z_vec, generator_dims, self.train_phase, scope_name="generator")
+        self.gen_images_out = self.gen_images
+
+    def _setup_network(self, generator_dims, discriminator_dims, num_towers, xla, critic_pass, fused_batch_norm,
+                       summary_level):
+        """
+        Network settings and placeholders shared by create_network and create_inference_network
+        """
+        if xla and fused_batch_norm:
+            # only the default batch norm selects its statistics without control flow
+            raise ValueError("The fused batch norm picks its kernel with a tf.cond, it cannot be compiled with XLA")
+        self.num_towers = num_towers
+        self.xla = xla
+        self.generator_dims = generator_dims
+        self.discriminator_dims = discriminator_dims
+        self.critic_pass = critic_pass
+        self.fused_batch_norm = fused_batch_norm
+        self.summary_level = summary_level
+        self.scalar_metrics = {}
+        self._setup_placeholder()
 
-    def initialize_network(self, logs_dir):
+    def _slot_initializer(self, var, optimizer):
+        """
+        Re-creates the optimizer slots of an iterator variable for its current batch size - run after initializing it
+        """
+        slots = [optimizer.get_slot(var, name) for name in optimizer.get_slot_names()]
+        return tf.variables_initializer([slot for slot in slots if slot is not None])
+
+    def _initialize_iterator(self, init_op, reset_slots_op, feed_dict):
+        self.sess.run(init_op, feed_dict=feed_dict)
+        self.sess.run(reset_slots_op)
+
+    def _create_fused_train_ops(self, optimizer, real_update_ops):
+        raise ValueError("Fused critic training is only supported by WasserstienGAN")
+
+    def initialize_network(self, logs_dir, checkpointing=True, checkpoint_every_steps=None,
+                           checkpoint_every_secs=None, keep_checkpoints=5, keep_checkpoint_every=0, master="",
+                           is_chief=True, intra_op_threads=0, inter_op_threads=0, checkpoint_dir=None):
+        """
+        :param checkpointing: set up the background checkpoint writer used by train_model
+        :param checkpoint_every_steps: steps between checkpoints, None for the model default
+        :param checkpoint_every_secs: also checkpoint when this many seconds passed since the last one
+        :param keep_checkpoints: recent checkpoints kept on disk (0 - all)
+        :param keep_checkpoint_every: additionally keep every n-th checkpoint for good (0 - none)
+        :param master: target of a tf.train.Server for distributed training, "" for a local session
+        :param is_chief: the chief worker initializes/restores the shared variables and alone writes checkpoints and
+        summaries, the other workers wait for it
+        :param intra_op_threads: threads available to a single op (0 - TF default, one per core)
+        :param inter_op_threads: ops run concurrently (0 - TF default)
+        :param checkpoint_dir: directory of the checkpoint to restore, None for logs_dir - e.g. a generator export
+        """
         print("Initializing network...")
         self.logs_dir = logs_dir
-        self.sess = tf.Session()
-        self.summary_op = tf.summary.merge_all()
+        self.checkpoint_dir = checkpoint_dir or logs_dir
+        self.is_chief = is_chief
+        config = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                                inter_op_parallelism_threads=inter_op_threads)
+        if self.num_towers > 1:
+            config.device_count["CPU"] = self.num_towers
+        self.summary_ops = {}
+        for level in SUMMARY_LEVELS[2:]:
+            summaries = tf.get_collection(self._summary_collections(level)[0])
+            if summaries:
+                self.summary_ops[level] = tf.summary.merge(summaries)
         variables = tf.global_variables()
         restore_variables = [v for v in variables if v.name.startswith("discriminator") or v.name.startswith("generator")]
         self.saver = tf.train.Saver(restore_variables)
-        self.summary_writer = tf.summary.FileWriter(self.logs_dir, self.sess.graph)
-
-        self.sess.run(tf.global_variables_initializer())
-        ckpt = tf.train.get_checkpoint_state(self.logs_dir)
+        self.summary_writer = None
+        if is_chief and (checkpointing or self._summary_enabled("scalars")):
+            self.summary_writer = tf.summary.FileWriter(self.logs_dir, tf.get_default_graph())
+
+        if master:
+            session_manager = tf.train.SessionManager(local_init_op=tf.local_variables_initializer(),
+                                                      ready_op=tf.report_uninitialized_variables())
+            if is_chief:
+                self.sess = session_manager.prepare_session(master, init_op=tf.global_variables_initializer(),
+                                                            init_fn=self._restore_checkpoint, config=config)
+            else:
+                print("Waiting for the chief to initialize the model...")
+                self.sess = session_manager.wait_for_session(master, config=config)
+        else:
+            self.sess = tf.Session(config=config)
+            # only the variables the checkpoint does not hold are initialized
+            restored_variables = restore_variables if self._restore_checkpoint(self.sess) else []
+            self.sess.run(tf.variables_initializer([v for v in variables if v not in restored_variables]))
+            self.sess.run(tf.local_variables_initializer())
+        self.checkpointer = None
+        if checkpointing and is_chief:
+            if checkpoint_every_steps is None:
+                checkpoint_every_steps = self.checkpoint_every
+            self.checkpointer = AsyncCheckpointer(self.sess, restore_variables, self.logs_dir + "model.ckpt",
+                                                  every_steps=checkpoint_every_steps, every_secs=checkpoint_every_secs,
+                                                  keep_last=keep_checkpoints, keep_every=keep_checkpoint_every,
+                                                  summary_writer=self.summary_writer)
+        self.coord = None
+        self.threads = []
+        if self.input_backend == "queue":
+            self.coord = tf.train.Coordinator()
+            self.threads = tf.train.start_queue_runners(self.sess, self.coord)
+        self._setup_input_monitor()
+
+    def _restore_checkpoint(self, sess):
+        """
+        :return: whether a checkpoint was restored
+        """
+        ckpt = tf.train.get_checkpoint_state(self.checkpoint_dir)
         if ckpt and ckpt.model_checkpoint_path:
-            self.saver.restore(self.sess, ckpt.model_checkpoint_path)
+            self.saver.restore(sess, ckpt.model_checkpoint_path)
             print("Model restored...")
-        self.coord = tf.train.Coordinator()
-        self.threads = tf.train.start_queue_runners(self.sess, self.coord)
+            return True
+        return False
+
+    def _setup_input_monitor(self):
+        self.input_monitor = None
+        if self.input_backend != "queue":
+            return
+        reader_pool = None
+        if self.adaptive_readers:
+            reader_pool = ReaderPool(self.sess, self.coord, self.input_enqueue_op, self.input_close_op,
+                                     self.input_queue_size, self.batch_size, self.max_queue_capacity,
+                                     num_threads=self.num_reader_threads, capacity=self.queue_capacity,
+                                     threads=self.threads)
+        self.input_monitor = InputMonitor(self.input_queue_size, self.examples_decoded, self.max_queue_capacity,
+                                          self.batch_size, self.input_dequeue_name, self.summary_writer,
+                                          reader_pool=reader_pool)
+
+    def _metric_fetches(self, discriminator_loss=None):
+        """
+        Scalars fetched alongside a train op - the losses always, for the console log, plus the scalar summaries.
+        """
+        metrics = dict(self.scalar_metrics)
+        metrics["Discriminator_loss"] = self.discriminator_loss if discriminator_loss is None else discriminator_loss
+        metrics["Generator_loss"] = self.gen_loss
+        return metrics
+
+    def _running_metrics(self):
+        return RunningMetrics(self.summary_writer if self._summary_enabled("scalars") else None)
+
+    def _due_summary_ops(self, itr):
+        if self.summary_writer is None:
+            return []
+        return [summary_op for level, summary_op in self.summary_ops.items() if itr % self.summary_every[level] == 0]
+
+    def _add_summaries(self, itr, summary_strs):
+        for summary_str in summary_strs:
+            self.summary_writer.add_summary(summary_str, itr)
+
+    def _maybe_checkpoint(self, itr):
+        if self.checkpointer is not None:
+            self.checkpointer.maybe_save(itr)
+
+    def _finish_training(self):
+        self._stop_input_threads()
+        if self.checkpointer is not None:
+            self.checkpointer.close()
+
+    def _stop_input_threads(self):
+        if self.coord is not None:
+            self.coord.request_stop()
+            self.coord.join(self.threads)  # Wait for threads to finish.
+
+    def _input_run_kwargs(self, itr):
+        if self.input_monitor is None:
+            return {}
+        return self.input_monitor.run_kwargs(itr)
+
+    def _monitor_input(self, itr, run_kwargs):
+        if self.input_monitor is not None:
+            self.input_monitor.step(self.sess, itr, run_kwargs)
 
     def train_model(self, max_iterations):
         try:
             print("Training model...")
+            feed_dict = {self.train_phase: True}
+            metric_fetches = self._metric_fetches()
+            metrics = self._running_metrics()
+            log_every = self.summary_every["scalars"]
             for itr in xrange(1, max_iterations):
-                batch_z = np.random.uniform(-1.0, 1.0, size=[self.batch_size, self.z_dim]).astype(np.float32)
-                feed_dict = {self.z_vec: batch_z, self.train_phase: True}
 
-                self.sess.run(self.discriminator_train_op, feed_dict=feed_dict)
+                run_kwargs = self._input_run_kwargs(itr)
+                # losses and due summaries come out of the discriminator step's forward pass
+                _, metric_values, summary_strs = self.sess.run(
+                    [self.discriminator_train_op, metric_fetches, self._due_summary_ops(itr)], feed_dict=feed_dict,
+                    **run_kwargs)
                 self.sess.run(self.generator_train_op, feed_dict=feed_dict)
+                self._monitor_input(itr, run_kwargs)
 
-                if itr % 10 == 0:
-                    g_loss_val, d_loss_val, summary_str = self.sess.run(
-                        [self.gen_loss, self.discriminator_loss, self.summary_op], feed_dict=feed_dict)
-                    print("Step: %d, generator loss: %g, discriminator_loss: %g" % (itr, g_loss_val, d_loss_val))
-                    self.summary_writer.add_summary(summary_str, itr)
+                metrics.add(metric_values)
+                self._add_summaries(itr, summary_strs)
+                if itr % log_every == 0:
+                    averages = metrics.flush(itr)
+                    print("Step: %d, generator loss: %g, discriminator_loss: %g" % (
+                        itr, averages["Generator_loss"], averages["Discriminator_loss"]))
 
-                if itr % 2000 == 0:
-                    self.saver.save(self.sess, self.logs_dir + "model.ckpt", global_step=itr)
+                self._maybe_checkpoint(itr)
 
         except tf.errors.OutOfRangeError:
             print('Done training -- epoch limit reached')
         except KeyboardInterrupt:
             print("Ending Training...")
         finally:
-            self.coord.request_stop()
-            self.coord.join(self.threads)  # Wait for threads to finish.
+            self._finish_training()
 
     def visualize_model(self):
         print("Sampling images from model...")
@@ -308,11 +836,40 @@ class GAN(object):
         shape = [4, self.batch_size // 4]
         utils.save_imshow_grid(images, self.logs_dir, "generated.png", shape=shape)
 
+    def sample_images(self, no_of_images, batch_size=None):
+        """
+        Generates no_of_images uint8 images. The sampling graph takes any batch size.
+        :param batch_size: images generated per session run, None for the training batch size
+        """
+        batch_size = batch_size or self.batch_size
+        images = []
+        for start in range(0, no_of_images, batch_size):
+            batch_z = np.random.uniform(-1.0, 1.0, size=[min(batch_size, no_of_images - start), self.z_dim])
+            images.append(self.sess.run(self.gen_images, feed_dict={self.z_vec: batch_z.astype(np.float32),
+                                                                    self.train_phase: False}))
+        return utils.unprocess_image(np.concatenate(images), 127.5, 127.5).astype(np.uint8)
+
+    def score_images(self, images, batch_size=None):
+        """
+        Discriminator logits of uint8 images of the generated size, one row per image. Takes any batch size.
+        """
+        batch_size = batch_size or self.batch_size
+        scores = []
+        for start in range(0, len(images), batch_size):
+            batch = utils.process_image(images[start:start + batch_size].astype(np.float32), 127.5, 127.5)
+            feed_dict = {self.real_images: batch, self.train_phase: False}
+            if self.critic_pass != "separate":
+                # the fake half of the single critic pass has to match the real batch
+                feed_dict[self.z_vec] = np.zeros([len(batch), self.z_dim], dtype=np.float32)
+            logits = self.sess.run(self.logits_real, feed_dict=feed_dict)
+            scores.append(logits.reshape(len(batch), -1))
+        return np.concatenate(scores)
+
     def image_iterator_visualize_model(self, nr_iterations=1000, plot_iteration_error=True):
         print("Sampling images from model...")
         batch_z = np.random.uniform(-1.0, 1.0, size=[self.batch_size, self.z_dim]).astype(np.float32)
         feed_dict = {self.z_vec: batch_z, self.train_phase: False}
-        self.sess.run(self.init_image_iterator, feed_dict=feed_dict)
+        self._initialize_iterator(self.init_image_iterator, self.reset_image_iterator_slots, feed_dict)
  
         images = self.sess.run(self.gen_images_out, feed_dict={self.train_phase: False})
         images = utils.unprocess_image(images, 127.5, 127.5).astype(np.uint8)
@@ -348,7 +905,7 @@ class GAN(object):
         print("Sampling images from model...")
         batch_z = np.random.uniform(-1.0, 1.0, size=[self.batch_size, self.z_dim]).astype(np.float32)
         feed_dict = {self.z_vec: batch_z, self.train_phase: False}
-        self.sess.run(self.init_z_iterator, feed_dict=feed_dict)
+        self._initialize_iterator(self.init_z_iterator, self.reset_z_iterator_slots, feed_dict)
  
         images = self.sess.run(self.gen_images_out, feed_dict={self.train_phase: False})
         #images = self.sess.run(self.gen_images, feed_dict=feed_dict)
@@ -390,7 +947,7 @@ class GAN(object):
         for i in tqdm(xrange(nr_batches_tsne)):
             batch_z = np.random.uniform(-1.0, 1.0, size=[self.batch_size, self.z_dim]).astype(np.float32)
             feed_dict = {self.z_vec: batch_z, self.train_phase: False}
-            self.sess.run(self.init_z_iterator, feed_dict=feed_dict)
+            self._initialize_iterator(self.init_z_iterator, self.reset_z_iterator_slots, feed_dict)
      
             for i in tqdm(xrange(nr_iterations)):
                 feed_dict = {self.train_phase: False}
@@ -406,6 +963,7 @@ class GAN(object):
         z_batch = z_batch.reshape((self.batch_size * nr_batches_tsne * (1+ (nr_iterations/record_freq)), self.z_dim))
 
         print("preforming tsne embedding...")
+        from sklearn import manifold  # slow to import and only needed here
         tsne = manifold.TSNE(n_components=2, init='pca', random_state=0)
         #tsne = manifold.TSNE(n_components=2)
         z_tsne = tsne.fit_transform(z_batch)
@@ -423,24 +981,28 @@ class GAN(object):
     
 
 class WasserstienGAN(GAN):
+    checkpoint_every = 5000
+    generator_loss_uses_real_images = False
+
     def __init__(self, z_dim, crop_image_size, resized_image_size, batch_size, data_dir, clip_values=(-0.01, 0.01),
-                 critic_iterations=5):
+                 critic_iterations=5, **kwargs):
         self.critic_iterations = critic_iterations
         self.clip_values = clip_values
-        GAN.__init__(self, z_dim, crop_image_size, resized_image_size, batch_size, data_dir)
+        GAN.__init__(self, z_dim, crop_image_size, resized_image_size, batch_size, data_dir, **kwargs)
 
     def _generator(self, z, dims, train_phase, activation=tf.nn.relu, scope_name="generator", scope_reuse=False):
         N = len(dims)
         image_size = self.resized_image_size // (2 ** (N - 1))
-        with tf.variable_scope(scope_name) as scope:
+        with tf.variable_scope(scope_name) as scope, utils.jit_scope(self.xla):
             if scope_reuse:
                 scope.reuse_variables()
             W_z = utils.weight_variable([self.z_dim, dims[0] * image_size * image_size], name="W_z")
             h_z = tf.matmul(z, W_z)
             h_z = tf.reshape(h_z, [-1, image_size, image_size, dims[0]])
-            h_bnz = utils.batch_norm(h_z, dims[0], train_phase, scope="gen_bnz")
+            h_bnz = utils.batch_norm(h_z, dims[0], train_phase, scope="gen_bnz",
+                                     fused=self.fused_batch_norm)
             h = activation(h_bnz, name='h_z')
-            utils.add_activation_summary(h)
+            self._activation_summary(h)
 
             for index in range(N - 2):
                 image_size *= 2
@@ -448,9 +1010,10 @@ class WasserstienGAN(GAN):
                 b = tf.zeros([dims[index + 1]])
                 deconv_shape = tf.stack([tf.shape(h)[0], image_size, image_size, dims[index + 1]])
                 h_conv_t = utils.conv2d_transpose_strided(h, W, b, output_shape=deconv_shape)
-                h_bn = utils.batch_norm(h_conv_t, dims[index + 1], train_phase, scope="gen_bn%d" % index)
+                h_bn = utils.batch_norm(h_conv_t, dims[index + 1], train_phase, scope="gen_bn%d" % index,
+                                        fused=self.fused_batch_norm)
                 h = activation(h_bn, name='h_%d' % index)
-                utils.add_activation_summary(h)
+                self._activation_summary(h)
 
             image_size *= 2
             W_pred = utils.weight_variable([4, 4, dims[-1], dims[-2]], name="W_pred")
@@ -458,14 +1021,14 @@ class WasserstienGAN(GAN):
             deconv_shape = tf.stack([tf.shape(h)[0], image_size, image_size, dims[-1]])
             h_conv_t = utils.conv2d_transpose_strided(h, W_pred, b, output_shape=deconv_shape)
             pred_image = tf.nn.tanh(h_conv_t, name='pred_image')
-            utils.add_activation_summary(pred_image)
+            self._activation_summary(pred_image)
 
         return pred_image
 
     def _discriminator(self, input_images, dims, train_phase, activation=tf.nn.relu, scope_name="discriminator",
-                       scope_reuse=False):
+                       scope_reuse=False, bn_splits=1):
         N = len(dims)
-        with tf.variable_scope(scope_name) as scope:
+        with tf.variable_scope(scope_name) as scope, utils.jit_scope(self.xla):
             if scope_reuse:
                 scope.reuse_variables()
             h = input_images
@@ -478,9 +1041,10 @@ class WasserstienGAN(GAN):
                     h_bn = h_conv
                     skip_bn = False
                 else:
-                    h_bn = utils.batch_norm(h_conv, dims[index + 1], train_phase, scope="disc_bn%d" % index)
+                    h_bn = utils.batch_norm(h_conv, dims[index + 1], train_phase, scope="disc_bn%d" % index,
+                                            num_splits=bn_splits, fused=self.fused_batch_norm)
                 h = activation(h_bn, name="h_%d" % index)
-                utils.add_activation_summary(h)
+                self._activation_summary(h)
 
             W_pred = utils.weight_variable([4, 4, dims[-2], dims[-1]], name="W_pred")
             b = tf.zeros([dims[-1]])
@@ -489,58 +1053,122 @@ class WasserstienGAN(GAN):
 
     def _gan_loss(self, logits_real, logits_fake, feature_real, feature_fake, use_features=False):
         self.discriminator_loss = tf.reduce_mean(logits_real - logits_fake)
+        self._generator_loss(logits_fake)
+
+    def _generator_loss(self, logits_fake, use_features=False):
         self.gen_loss = tf.reduce_mean(logits_fake)
         self.gen_loss_full = tf.reduce_mean(logits_fake, axis=(1,2,3))
 
-        tf.summary.scalar("Discriminator_loss", self.discriminator_loss)
-        tf.summary.scalar("Generator_loss", self.gen_loss)
+    def _clip_discriminator_vars(self):
+        return tf.group(*[var.assign(tf.clip_by_value(var, self.clip_values[0], self.clip_values[1])) for
+                          var in self.discriminator_variables])
+
+    def _critic_loop(self, optimizer, after=None):
+        """
+        tf.while_loop of self.critic_itrs critic updates, each on a fresh input batch and z and followed by the weight
+        clip. The network copies in the loop body share the trained variables and optimizer slots but use batch
+        statistics only.
+        :param after: op the loop has to wait for
+        :return: discriminator loss of the last critic step, fetching it runs the loop
+        """
+        def critic_step(i, _):
+            images = self._next_batch()
+            z = self._sample_z()
+            gen_images = self._generator(z, self.generator_dims, True, scope_name="generator", scope_reuse=True)
+            logits_real, logits_fake, _, _ = self._critic(images, gen_images, True)
+            discriminator_loss = tf.reduce_mean(logits_real - logits_fake)
+            grads = optimizer.compute_gradients(discriminator_loss, var_list=self.discriminator_variables)
+            with tf.control_dependencies([optimizer.apply_gradients(grads)]):
+                clip_op = self._clip_discriminator_vars()
+            with tf.control_dependencies([clip_op]):
+                return i + 1, tf.identity(discriminator_loss)
+
+        with tf.control_dependencies([after] if after is not None else []):
+            start = tf.constant(0)
+        # tensors inside the loop body cannot be fetched by the summary ops
+        summary_level, self.summary_level = self.summary_level, "off"
+        _, critic_loss = tf.while_loop(lambda i, loss: i < self.critic_itrs, critic_step, [start, tf.constant(0.0)],
+                                       parallel_iterations=1, back_prop=False, name="critic_loop")
+        self.summary_level = summary_level
+        return critic_loss
+
+    def _create_fused_train_ops(self, optimizer, real_update_ops):
+        """
+        :param real_update_ops: batch norm moving average updates of the critic pass on real images. The critic steps
+        in the loop use batch statistics only and the generator step runs the critic on generated images only, so
+        fused_train_op runs these once per iteration on a real batch - otherwise the averages used by the critic at
+        train_phase=False would stay at their zero start.
+        """
+        self.critic_itrs = tf.placeholder_with_default(self.critic_iterations, [], name="critic_iterations")
+        # critic_loop_op runs the critic steps before the first generator step, fused_train_op the generator step and
+        # then the critic steps of the following iteration
+        self.critic_loop_op = self._critic_loop(optimizer).op
+        # discriminator loss of the last critic step of the loop
+        self.fused_critic_loss = self._critic_loop(optimizer, after=self.generator_train_op)
+        self.fused_train_op = tf.group(self.fused_critic_loss, *real_update_ops)
+
+    def _critic_schedule(self, itr):
+        if itr < 25 or itr % 500 == 0:
+            return 25
+        return self.critic_iterations
 
     def train_model(self, max_iterations):
         try:
             print("Training Wasserstein GAN model...")
-            clip_discriminator_var_op = [var.assign(tf.clip_by_value(var, self.clip_values[0], self.clip_values[1])) for
-                                         var in self.discriminator_variables]
+            clip_discriminator_var_op = self._clip_discriminator_vars()
 
             start_time = time.time()
 
-            def get_feed_dict(train_phase=True):
-                batch_z = np.random.uniform(-1.0, 1.0, size=[self.batch_size, self.z_dim]).astype(np.float32)
-                feed_dict = {self.z_vec: batch_z, self.train_phase: train_phase}
-                return feed_dict
+            feed_dict = {self.train_phase: True}
+            metrics = self._running_metrics()
+            log_every = self.summary_every["scalars"]
+            if self.fused_critic:
+                # the loss of the last in-graph critic step stands in for the discriminator loss
+                metric_fetches = self._metric_fetches(discriminator_loss=self.fused_critic_loss)
+                self.sess.run(self.critic_loop_op, feed_dict={self.critic_itrs: self._critic_schedule(1)})
+            else:
+                metric_fetches = self._metric_fetches()
 
             for itr in xrange(1, max_iterations):
-                if itr < 25 or itr % 500 == 0:
-                    critic_itrs = 25
+                run_kwargs = self._input_run_kwargs(itr)
+                summary_ops = self._due_summary_ops(itr)
+                if self.fused_critic:
+                    fused_feed_dict = dict(feed_dict)
+                    fused_feed_dict[self.critic_itrs] = self._critic_schedule(itr + 1)
+                    _, metric_values, summary_strs = self.sess.run([self.fused_train_op, metric_fetches, summary_ops],
+                                                                   feed_dict=fused_feed_dict, **run_kwargs)
+                    self._monitor_input(itr, run_kwargs)
                 else:
-                    critic_itrs = self.critic_iterations
-
-                for critic_itr in range(critic_itrs):
-                    self.sess.run(self.discriminator_train_op, feed_dict=get_feed_dict(True))
-                    self.sess.run(clip_discriminator_var_op)
-
-                feed_dict = get_feed_dict(True)
-                self.sess.run(self.generator_train_op, feed_dict=feed_dict)
-
-                if itr % 100 == 0:
-                    summary_str = self.sess.run(self.summary_op, feed_dict=feed_dict)
-                    self.summary_writer.add_summary(summary_str, itr)
-
-                if itr % 200 == 0:
+                    critic_itrs = self._critic_schedule(itr)
+                    for critic_itr in range(critic_itrs):
+                        fetches = [self.discriminator_train_op]
+                        if critic_itr == critic_itrs - 1:
+                            # losses and due summaries come out of the last critic step's forward pass
+                            fetches += [metric_fetches, summary_ops]
+                        results = self.sess.run(fetches, feed_dict=feed_dict,
+                                                **(run_kwargs if critic_itr == 0 else {}))
+                        self.sess.run(clip_discriminator_var_op)
+                    metric_values, summary_strs = results[1:]
+                    self._monitor_input(itr, run_kwargs)
+
+                    self.sess.run(self.generator_train_op, feed_dict=feed_dict)
+
+                metrics.add(metric_values)
+                self._add_summaries(itr, summary_strs)
+
+                if itr % log_every == 0:
                     stop_time = time.time()
-                    duration = (stop_time - start_time) / 200.0
+                    duration = (stop_time - start_time) / log_every
                     start_time = stop_time
-                    g_loss_val, d_loss_val = self.sess.run([self.gen_loss, self.discriminator_loss],
-                                                           feed_dict=feed_dict)
-                    print("Time: %g/itr, Step: %d, generator loss: %g, discriminator_loss: %g" % (
-                        duration, itr, g_loss_val, d_loss_val))
+                    averages = metrics.flush(itr)
+                    print("Time: %g/itr (%.2f steps/sec), Step: %d, generator loss: %g, discriminator_loss: %g" % (
+                        duration, 1.0 / duration, itr, averages["Generator_loss"], averages["Discriminator_loss"]))
 
-                if itr % 5000 == 0:
-                    self.saver.save(self.sess, self.logs_dir + "model.ckpt", global_step=itr)
+                self._maybe_checkpoint(itr)
 
         except tf.errors.OutOfRangeError:
             print('Done training -- epoch limit reached')
         except KeyboardInterrupt:
             print("Ending Training...")
         finally:
-            self.coord.request_stop()
-            self.coord.join(self.threads)  # Wait for threads to finish.
+            self._finish_training()
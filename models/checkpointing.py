@@ -0,0 +1,115 @@
+from __future__ import print_function
+
+__author__ = "shekkizh"
+"""
+Background checkpoint writer - the train loop only pays for an in-memory copy of the variables
+"""
+import os
+import threading
+import time
+import tensorflow as tf
+
+
+class AsyncCheckpointer(object):
+    """
+    Copies the variables into snapshot variables on the train thread and writes the snapshot on a background thread.
+    Checkpoints use the original variable names, so a plain tf.train.Saver over the variables restores them.
+    Retention keeps the last keep_last checkpoints plus every keep_every-th one written by this checkpointer.
+    Checkpoints of an earlier run in the same directory count towards it, see _previous_checkpoints.
+    """
+
+    def __init__(self, sess, variables, save_path, every_steps=None, every_secs=None, keep_last=5, keep_every=0,
+                 summary_writer=None):
+        self.sess = sess
+        self.save_path = save_path
+        self.every_steps = every_steps
+        self.every_secs = every_secs
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self.summary_writer = summary_writer
+        with tf.name_scope("checkpoint_snapshot"):
+            snapshots = []
+            for var in variables:
+                with tf.colocate_with(var):
+                    snapshots.append(tf.Variable(tf.zeros(var.get_shape(), var.dtype.base_dtype), trainable=False,
+                                                 collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                                                 name=var.op.name.replace('/', '_')))
+            self.snapshot_op = tf.group(*[snapshot.assign(var) for snapshot, var in zip(snapshots, variables)])
+        self.saver = tf.train.Saver(dict((var.op.name, snapshot) for var, snapshot in zip(variables, snapshots)),
+                                    max_to_keep=None, sharded=False)
+        self.sess.run(tf.variables_initializer(snapshots))
+        self._kept = self._previous_checkpoints()
+        self._no_of_saves = 0
+        self._last_save_time = time.time()
+        self._writer_thread = None
+        self.stall_ms = []
+
+    def due(self, step):
+        if self.every_steps and step % self.every_steps == 0:
+            return True
+        return bool(self.every_secs) and time.time() - self._last_save_time >= self.every_secs
+
+    def maybe_save(self, step):
+        if self.due(step):
+            self.save(step)
+
+    def save(self, step):
+        start_time = time.time()
+        self._wait()  # the snapshot is still being written
+        self.sess.run(self.snapshot_op)
+        stall_ms = 1000 * (time.time() - start_time)
+        self.stall_ms.append(stall_ms)
+        self._last_save_time = time.time()
+        self._no_of_saves += 1
+        permanent = self.keep_every > 0 and self._no_of_saves % self.keep_every == 0
+        self._writer_thread = threading.Thread(target=self._write, args=(step, stall_ms, permanent))
+        self._writer_thread.daemon = True
+        self._writer_thread.start()
+
+    def _write(self, step, stall_ms, permanent):
+        start_time = time.time()
+        path = self.saver.save(self.sess, self.save_path, global_step=step, write_meta_graph=False)
+        self._apply_retention(path, permanent)
+        write_ms = 1000 * (time.time() - start_time)
+        print("Checkpoint %s: train loop stalled %.1f ms, written in %.1f ms" % (path, stall_ms, write_ms))
+        if self.summary_writer is not None:
+            self.summary_writer.add_summary(tf.Summary(value=[
+                tf.Summary.Value(tag="checkpoint/stall_ms", simple_value=stall_ms),
+                tf.Summary.Value(tag="checkpoint/write_ms", simple_value=write_ms)]), step)
+
+    def _previous_checkpoints(self):
+        """
+        (path, permanent) of the checkpoints listed in the checkpoint state of save_path's directory. Retention
+        leaves only permanent checkpoints before the last keep_last, so those are permanent - the last keep_last are
+        treated as recent (all of them without keep_every).
+        """
+        checkpoint_dir = os.path.dirname(self.save_path)
+        state = tf.train.get_checkpoint_state(checkpoint_dir)
+        if state is None:
+            return []
+        # the form saver.save returns, so a re-saved step replaces its entry
+        paths = [os.path.join(checkpoint_dir, os.path.basename(path)) for path in state.all_model_checkpoint_paths]
+        no_of_recent = len(paths) if not self.keep_every else self.keep_last
+        return [(path, index < len(paths) - no_of_recent) for index, path in enumerate(paths)]
+
+    def _apply_retention(self, path, permanent):
+        self._kept = [item for item in self._kept if item[0] != path] + [(path, permanent)]
+        recent = [kept_path for kept_path, kept_permanent in self._kept if not kept_permanent]
+        expired = set(recent[:-self.keep_last]) if self.keep_last else set()
+        for expired_path in expired:
+            for filename in tf.gfile.Glob(expired_path + ".*"):
+                tf.gfile.Remove(filename)
+        self._kept = [item for item in self._kept if item[0] not in expired]
+        tf.train.update_checkpoint_state(os.path.dirname(self.save_path), path,
+                                         all_model_checkpoint_paths=[kept_path for kept_path, _ in self._kept])
+
+    def _wait(self):
+        if self._writer_thread is not None:
+            self._writer_thread.join()
+            self._writer_thread = None
+
+    def close(self):
+        """
+        Waits for the checkpoint being written.
+        """
+        self._wait()
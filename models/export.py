@@ -0,0 +1,55 @@
+from __future__ import print_function
+
+__author__ = "shekkizh"
+"""
+Generator-only export - the generator weights and the architecture needed to rebuild the generator, without the
+critic, optimizer state or dataset
+"""
+import json
+import os
+import tensorflow as tf
+import utils as utils
+from models.GAN_models import GAN, WasserstienGAN
+
+ARCHITECTURE_FILENAME = "generator.json"
+CHECKPOINT_NAME = "generator.ckpt"
+MODEL_CLASSES = {"GAN": GAN, "WasserstienGAN": WasserstienGAN}
+
+
+def export_generator(model, export_dir):
+    """
+    Writes the generator variables of the model's session and its architecture to export_dir. The model has to be
+    restored from a training checkpoint, e.g. built with create_inference_network and initialized from logs_dir.
+    :return: path of the exported checkpoint
+    """
+    if not tf.train.get_checkpoint_state(model.checkpoint_dir):
+        raise ValueError("No checkpoint in %s to export" % model.checkpoint_dir)
+    if not os.path.exists(export_dir):
+        os.makedirs(export_dir)
+    generator_variables = [v for v in tf.global_variables() if v.name.startswith("generator")]
+    # relative paths in the checkpoint state, so the export can be copied to the inference hosts
+    saver = tf.train.Saver(generator_variables, save_relative_paths=True)
+    path = saver.save(model.sess, os.path.join(export_dir, CHECKPOINT_NAME), write_meta_graph=False)
+    architecture = {"model": type(model).__name__, "z_dim": model.z_dim, "crop_image_size": model.crop_image_size,
+                    "resized_image_size": model.resized_image_size, "batch_size": model.batch_size,
+                    "generator_dims": model.generator_dims, "version": utils.code_version()}
+    with open(os.path.join(export_dir, ARCHITECTURE_FILENAME), 'w') as f:
+        json.dump(architecture, f, indent=2, sort_keys=True)
+    print("Generator exported to %s - %d variables (%.1f MB)" % (
+        path, len(generator_variables), utils.variables_size_mb(generator_variables)))
+    return path
+
+
+def build_generator(export_dir, batch_size=None, xla=False, fused_batch_norm=False):
+    """
+    Builds the sampling graph of an exported generator from its architecture alone - no dataset or training flags.
+    Follow with initialize_network(logs_dir, checkpointing=False, checkpoint_dir=export_dir) to load the weights.
+    :param batch_size: default number of z sampled per run, None for the batch size the generator was trained with
+    """
+    with open(os.path.join(export_dir, ARCHITECTURE_FILENAME)) as f:
+        architecture = json.load(f)
+    model = MODEL_CLASSES[architecture["model"]](architecture["z_dim"], architecture["crop_image_size"],
+                                                 architecture["resized_image_size"],
+                                                 batch_size or architecture["batch_size"], None, input_backend=None)
+    model.create_inference_network(architecture["generator_dims"], xla=xla, fused_batch_norm=fused_batch_norm)
+    return model
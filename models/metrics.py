@@ -0,0 +1,38 @@
+from __future__ import print_function
+
+__author__ = "shekkizh"
+"""
+Running averages of the scalar values fetched with the train ops
+"""
+import tensorflow as tf
+
+
+class RunningMetrics(object):
+    """
+    Accumulates the scalars of every step and flushes their window averages as one summary. FileWriter queues events
+    and writes them on its own thread, so a flush costs the train loop no I/O.
+    """
+
+    def __init__(self, summary_writer=None):
+        self.summary_writer = summary_writer
+        self._reset()
+
+    def _reset(self):
+        self._sums = {}
+        self._counts = {}
+
+    def add(self, values):
+        for name, value in values.items():
+            self._sums[name] = self._sums.get(name, 0.0) + float(value)
+            self._counts[name] = self._counts.get(name, 0) + 1
+
+    def flush(self, step):
+        """
+        :return: averages of the window since the last flush
+        """
+        averages = dict((name, self._sums[name] / self._counts[name]) for name in self._sums)
+        if self.summary_writer is not None and averages:
+            self.summary_writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag=name, simple_value=value)
+                                                              for name, value in sorted(averages.items())]), step)
+        self._reset()
+        return averages
@@ -0,0 +1,128 @@
+from __future__ import print_function
+
+__author__ = "shekkizh"
+"""
+Training step benchmark - steps/sec, graph build time, summary and sampling step cost of GAN / WassersteinGAN
+training variants on the same input pipeline, per model and batch size.
+Runs against the real dataset in data_dir, or a generated synthetic corpus with --synthetic_images.
+"""
+import json
+import multiprocessing
+import shutil
+import tempfile
+import time
+import tensorflow as tf
+from models.GAN_models import GAN, WasserstienGAN
+import utils as utils
+from Dataset_Reader.synthetic_celebA import generate_synthetic_dataset
+
+FLAGS = tf.flags.FLAGS
+tf.flags.DEFINE_string("batch_sizes", "64", "comma separated batch sizes to benchmark")
+tf.flags.DEFINE_string("models", "1", "comma separated models to benchmark. 0 - GAN, 1 - WassersteinGAN")
+tf.flags.DEFINE_string("data_dir", "Data_zoo/CelebA_faces/", "path to dataset")
+tf.flags.DEFINE_integer("z_dim", "100", "size of input vector to generator")
+tf.flags.DEFINE_string("image_size", "108,64", "Size of actual images, Size of images to be generated at.")
+tf.flags.DEFINE_integer("gen_dimension", "16", "dimension of first layer in generator")
+tf.flags.DEFINE_string("optimizer", "RMSProp", "Optimizer to use for training")
+tf.flags.DEFINE_float("learning_rate", "5e-5", "Learning rate")
+tf.flags.DEFINE_float("optimizer_param", "0.9", "beta1 for Adam optimizer / decay for RMSProp")
+tf.flags.DEFINE_string("input_backend", "dataset", "input backend feeding the model")
+tf.flags.DEFINE_string("variants", "loop,fused_critic", "comma separated training variants to compare")
+tf.flags.DEFINE_integer("steps", "100", "generator steps timed per variant (the first 24 run 25 critic steps each)")
+tf.flags.DEFINE_integer("summary_runs", "10",
+                        "runs of each summary op / of the sampling graph / of a lone critic step timed per variant")
+tf.flags.DEFINE_integer("synthetic_images", "0", "generate a synthetic corpus of this many images in data_dir (0 - off)")
+tf.flags.DEFINE_string("json_output", "", "write the results to this JSON file")
+
+# create_network arguments of each training variant
+VARIANTS = {"loop": {},
+            "fused_critic": {"fused_critic": True},
+            "summaries_off": {"summary_level": "off"},
+            "summaries_scalars": {"summary_level": "scalars"},
+            "summaries_images": {"summary_level": "images"},
+            "summaries_histograms": {"summary_level": "histograms"}}
+for towers in (1, 2, 4, 8, 16):
+    VARIANTS["towers_%d" % towers] = {"num_towers": towers}
+VARIANTS["xla"] = {"xla": True}
+for critic_pass in ("separate", "split", "joint"):
+    VARIANTS["critic_" + critic_pass] = {"critic_pass": critic_pass}
+VARIANTS["fused_batch_norm"] = {"fused_batch_norm": True}
+MODELS = {0: GAN, 1: WasserstienGAN}
+
+
+def benchmark_variant(model_id, batch_size, variant, crop_image_size, resized_image_size):
+    gen_dim = FLAGS.gen_dimension
+    generator_dims = [64 * gen_dim, 64 * gen_dim // 2, 64 * gen_dim // 4, 64 * gen_dim // 8, 3]
+    discriminator_dims = [3, 64, 64 * 2, 64 * 4, 64 * 8, 1]
+    model = MODELS[model_id](FLAGS.z_dim, crop_image_size, resized_image_size, batch_size, FLAGS.data_dir,
+                             input_backend=FLAGS.input_backend)
+    start_time = time.time()
+    model.create_network(generator_dims, discriminator_dims, FLAGS.optimizer, FLAGS.learning_rate,
+                         FLAGS.optimizer_param, **VARIANTS[variant])
+    build_time = time.time() - start_time
+    logs_dir = tempfile.mkdtemp() + "/"
+    try:
+        model.initialize_network(logs_dir)
+        summary_ms = {}
+        for level, summary_op in model.summary_ops.items():
+            model.sess.run(summary_op, feed_dict={model.train_phase: True})
+            start_time = time.time()
+            for _ in range(FLAGS.summary_runs):
+                model.sess.run(summary_op, feed_dict={model.train_phase: True})
+            summary_ms[level] = 1000 * (time.time() - start_time) / FLAGS.summary_runs
+        model.sess.run(model.gen_images, feed_dict={model.train_phase: False})
+        start_time = time.time()
+        for _ in range(FLAGS.summary_runs):
+            model.sess.run(model.gen_images, feed_dict={model.train_phase: False})
+        sample_ms = 1000 * (time.time() - start_time) / FLAGS.summary_runs
+        model.sess.run(model.discriminator_train_op, feed_dict={model.train_phase: True})
+        start_time = time.time()
+        for _ in range(FLAGS.summary_runs):
+            model.sess.run(model.discriminator_train_op, feed_dict={model.train_phase: True})
+        critic_step_ms = 1000 * (time.time() - start_time) / FLAGS.summary_runs
+        start_time = time.time()
+        model.train_model(FLAGS.steps + 1)
+        duration = time.time() - start_time
+    finally:
+        shutil.rmtree(logs_dir)
+    return {"steps_per_sec": FLAGS.steps / duration, "samples_per_sec": FLAGS.steps * batch_size / duration,
+            "graph_build_sec": build_time, "summary_ms": summary_ms, "sample_ms": sample_ms,
+            "critic_step_ms": critic_step_ms, "peak_rss_mb": utils.peak_rss_mb()}
+
+
+def main(argv=None):
+    crop_image_size, resized_image_size = map(int, FLAGS.image_size.split(','))
+    if FLAGS.synthetic_images:
+        generate_synthetic_dataset(FLAGS.data_dir, FLAGS.synthetic_images)
+
+    report = {"version": utils.code_version(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "config": {"image_size": FLAGS.image_size, "steps": FLAGS.steps, "input_backend": FLAGS.input_backend,
+                         "cpu_count": multiprocessing.cpu_count()},
+              "runs": {}}
+    variants = FLAGS.variants.split(',')
+    for model_id in map(int, FLAGS.models.split(',')):
+        for batch_size in map(int, FLAGS.batch_sizes.split(',')):
+            run = "model%d_batch%d" % (model_id, batch_size)
+            results = report["runs"][run] = {}
+            for variant in variants:
+                results[variant] = utils.run_isolated(benchmark_variant, model_id, batch_size, variant,
+                                                      crop_image_size, resized_image_size)
+
+            baseline = results[variants[0]]["steps_per_sec"]
+            for variant in variants:
+                result = results[variant]
+                print("%s %-20s %8.2f steps/sec  %9.1f samples/sec  (%.2fx vs %s)  critic step %.1f ms  sampling "
+                      "%.1f ms  graph build %.2f s  peak RSS %.0f MB%s" % (
+                          run, variant, result["steps_per_sec"], result["samples_per_sec"],
+                          result["steps_per_sec"] / baseline, variants[0], result["critic_step_ms"], result["sample_ms"],
+                          result["graph_build_sec"], result["peak_rss_mb"],
+                          "".join("  %s summary %.1f ms" % item for item in sorted(result["summary_ms"].items()))))
+
+    if FLAGS.json_output:
+        with open(FLAGS.json_output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print("Results written to %s" % FLAGS.json_output)
+
+
+if __name__ == "__main__":
+    tf.app.run()
@@ -0,0 +1,6 @@
+python train_benchmark.py --data_dir=Data_zoo/synthetic_faces/ --synthetic_images=5000 --variants=loop,fused_critic --json_output=logs/train_benchmark.json
+python train_benchmark.py --data_dir=Data_zoo/synthetic_faces/ --synthetic_images=5000 --variants=summaries_off,summaries_scalars,summaries_images,summaries_histograms --json_output=logs/summary_benchmark.json
+python train_benchmark.py --data_dir=Data_zoo/synthetic_faces/ --synthetic_images=5000 --variants=towers_1,towers_2,towers_4,towers_8,towers_16 --json_output=logs/tower_benchmark.json
+python train_benchmark.py --data_dir=Data_zoo/synthetic_faces/ --synthetic_images=5000 --models=0,1 --batch_sizes=16,64,256 --variants=loop,xla --json_output=logs/xla_benchmark.json
+python train_benchmark.py --data_dir=Data_zoo/synthetic_faces/ --synthetic_images=5000 --models=0,1 --variants=critic_separate,critic_split,critic_joint --json_output=logs/critic_pass_benchmark.json
+python train_benchmark.py --data_dir=Data_zoo/synthetic_faces/ --synthetic_images=5000 --models=0,1 --variants=loop,fused_batch_norm --json_output=logs/batch_norm_benchmark.json
@@ -4,7 +4,12 @@ import tensorflow as tf
 import numpy as np
 import scipy.misc as misc
 import os, sys
-from six.moves import urllib
+import contextlib
+import multiprocessing
+import resource
+import subprocess
+import traceback
+from six.moves import queue, urllib
 import tarfile
 import zipfile
 from tqdm import trange
@@ -122,9 +127,18 @@ def local_response_norm(x):
     return tf.nn.lrn(x, depth_radius=5, bias=2, alpha=1e-4, beta=0.75)
 
 
-def batch_norm(x, n_out, phase_train, scope='bn', decay=0.9, eps=1e-5, stddev=0.02):
+def batch_norm(x, n_out, phase_train, scope='bn', decay=0.9, eps=1e-5, stddev=0.02, num_splits=1, fused=False):
     """
     Code taken from http://stackoverflow.com/a/34634291/2267819
+    phase_train may also be the Python constant True for training-only copies of a network (e.g. built inside a
+    tf.while_loop) - batch statistics are used and no moving averages are created or updated.
+    Instead of a tf.cond the phase selects the statistics with a select op, and the moving average update is added to
+    tf.GraphKeys.UPDATE_OPS for the train ops to run rather than chained to the output. The data path has no control
+    flow or variable writes and can be compiled by XLA, and inference only reads the moving averages.
+    :param num_splits: normalize each of num_splits equal slices of the batch with its own statistics, e.g. the real
+    and fake halves of a concatenated critic batch. The moving averages track the first slice under the names the
+    unsplit layer uses.
+    :param fused: see fused_batch_norm
     """
     with tf.variable_scope(scope):
         
@@ -132,21 +146,86 @@ def batch_norm(x, n_out, phase_train, scope='bn', decay=0.9, eps=1e-5, stddev=0.
                                , trainable=True)
         gamma = tf.get_variable(name='gamma', shape=[n_out], initializer=tf.random_normal_initializer(1.0, stddev),
                                 trainable=True)
-        batch_mean, batch_var = tf.nn.moments(x, [0, 1, 2], name='moments')
-        ema = tf.train.ExponentialMovingAverage(decay=decay)
-
-        def mean_var_with_update():
-            ema_apply_op = ema.apply([batch_mean, batch_var])
-            with tf.control_dependencies([ema_apply_op]):
-                return tf.identity(batch_mean), tf.identity(batch_var)
-        with tf.variable_scope(tf.get_variable_scope(), reuse=False):
-            mean, var = tf.cond(phase_train,
-                                mean_var_with_update,
-                                lambda: (ema.average(batch_mean), ema.average(batch_var)))
-        normed = tf.nn.batch_normalization(x, mean, var, beta, gamma, eps)
+        if fused:
+            return fused_batch_norm(x, n_out, phase_train, beta, gamma, decay, eps, num_splits)
+        if num_splits > 1:
+            input_shape = tf.shape(x)
+            x = tf.reshape(x, [num_splits, -1] + x.get_shape().as_list()[1:])
+            split_mean, split_var = tf.nn.moments(x, [1, 2, 3], keep_dims=True, name='split_moments')
+            with tf.name_scope('moments'):
+                batch_mean = tf.identity(tf.reshape(split_mean[0], [n_out]), name='Squeeze')
+                batch_var = tf.identity(tf.reshape(split_var[0], [n_out]), name='Squeeze_1')
+        else:
+            batch_mean, batch_var = tf.nn.moments(x, [0, 1, 2], name='moments')
+            split_mean, split_var = batch_mean, batch_var
+        if phase_train is True:
+            normed = tf.nn.batch_normalization(x, split_mean, split_var, beta, gamma, eps)
+        else:
+            ema = tf.train.ExponentialMovingAverage(decay=decay)
+            with tf.variable_scope(tf.get_variable_scope(), reuse=False):
+                tf.add_to_collection(tf.GraphKeys.UPDATE_OPS, ema.apply([batch_mean, batch_var]))
+            ema_mean, ema_var = ema.average(batch_mean), ema.average(batch_var)
+            if num_splits > 1:
+                ema_mean, ema_var = tf.zeros_like(split_mean) + ema_mean, tf.zeros_like(split_var) + ema_var
+            mean = tf.where(phase_train, split_mean, ema_mean)
+            var = tf.where(phase_train, split_var, ema_var)
+            normed = tf.nn.batch_normalization(x, mean, var, beta, gamma, eps)
+        if num_splits > 1:
+            normed = tf.reshape(normed, input_shape)
     return normed
 
 
+def fused_batch_norm(x, n_out, phase_train, beta, gamma, decay=0.9, eps=1e-5, num_splits=1):
+    """
+    batch_norm with the statistics and the normalization of each split computed by one fused kernel. The phase picks
+    the training or inference kernel with a tf.cond - selecting the statistics with tf.where as batch_norm does would
+    need the training kernel for them plus the inference kernel for the output, so this path is not for XLA.
+    As in batch_norm the moving average updates are added to tf.GraphKeys.UPDATE_OPS for the train ops to run.
+    The moving averages are created under the names ExponentialMovingAverage gives them in batch_norm, so checkpoints
+    of either implementation restore into the other.
+    """
+    splits = tf.split(x, num_splits) if num_splits > 1 else [x]
+
+    def normalize(moving_mean=None, moving_var=None):
+        outputs = [tf.nn.fused_batch_norm(split, gamma, beta, mean=moving_mean, variance=moving_var, epsilon=eps,
+                                          is_training=moving_mean is None) for split in splits]
+        normed = tf.concat([output[0] for output in outputs], 0) if num_splits > 1 else outputs[0][0]
+        if moving_mean is not None:
+            return normed, tf.identity(moving_mean), tf.identity(moving_var)
+        # the fused kernel returns the unbiased variance, the moving average tracks the biased one of tf.nn.moments
+        _, mean, var = outputs[0]
+        sample_size = tf.cast(tf.size(splits[0]) // n_out, tf.float32)
+        return normed, mean, var * (sample_size - 1) / sample_size
+
+    if phase_train is True:
+        return normalize()[0]
+
+    with tf.name_scope('moments') as moments_scope:
+        pass
+    with tf.variable_scope(tf.get_variable_scope(), reuse=False):
+        moving_mean = tf.get_variable(moments_scope + 'Squeeze/ExponentialMovingAverage', [n_out],
+                                      initializer=tf.zeros_initializer(), trainable=False)
+        moving_var = tf.get_variable(moments_scope + 'Squeeze_1/ExponentialMovingAverage', [n_out],
+                                     initializer=tf.zeros_initializer(), trainable=False)
+    normed, mean, var = tf.cond(phase_train, normalize, lambda: normalize(moving_mean, moving_var))
+    # outside training mean and var are the moving averages, so the updates leave them unchanged
+    tf.add_to_collection(tf.GraphKeys.UPDATE_OPS, tf.assign_sub(moving_mean, (1 - decay) * (moving_mean - mean)))
+    tf.add_to_collection(tf.GraphKeys.UPDATE_OPS, tf.assign_sub(moving_var, (1 - decay) * (moving_var - var)))
+    return normed
+
+
+@contextlib.contextmanager
+def jit_scope(enabled=True):
+    """
+    Ops built inside are compiled with XLA when enabled
+    """
+    if enabled:
+        with tf.contrib.compiler.jit.experimental_jit_scope():
+            yield
+    else:
+        yield
+
+
 def process_image(image, mean_pixel, norm):
     return (image - mean_pixel) / norm
 
@@ -161,14 +240,103 @@ def add_to_regularization_and_summary(var):
         tf.add_to_collection("reg_loss", tf.nn.l2_loss(var))
 
 
-def add_activation_summary(var):
-    tf.summary.histogram(var.op.name + "/activation", var)
-    tf.summary.scalar(var.op.name + "/sparsity", tf.nn.zero_fraction(var))
+def add_activation_summary(var, collections=None):
+    tf.summary.histogram(var.op.name + "/activation", var, collections=collections)
+    tf.summary.scalar(var.op.name + "/sparsity", tf.nn.zero_fraction(var), collections=collections)
 
 
-def add_gradient_summary(grad, var):
+def add_gradient_summary(grad, var, collections=None):
     if grad is not None:
-        tf.summary.histogram(var.op.name + "/gradient", grad)
+        tf.summary.histogram(var.op.name + "/gradient", grad, collections=collections)
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0  # ru_maxrss is in KB on Linux
+
+
+def variables_size_mb(variables):
+    """
+    Memory held by the variables. Those without a fully defined shape (validate_shape=False) are not counted.
+    """
+    size = 0
+    for var in variables:
+        shape = var.get_shape()
+        if shape.is_fully_defined():
+            size += shape.num_elements() * var.dtype.base_dtype.size
+    return size / 2.0 ** 20
+
+
+def run_isolated(function, *args):
+    """
+    Runs function in a forked child so its graph, threads and peak RSS do not leak into other measurements.
+    Raises RuntimeError if the child raises (with its traceback) or dies without a result (e.g. OOM-killed).
+    """
+    results = multiprocessing.Queue()
+
+    def target():
+        try:
+            results.put((True, function(*args)))
+        except BaseException:
+            results.put((False, traceback.format_exc()))
+
+    process = multiprocessing.Process(target=target)
+    process.start()
+    while True:
+        try:
+            ok, result = results.get(timeout=1)
+            break
+        except queue.Empty:
+            if not process.is_alive():
+                # the result may have been put just before the child exited
+                try:
+                    ok, result = results.get(timeout=1)
+                    break
+                except queue.Empty:
+                    process.join()
+                    raise RuntimeError("%s exited with code %s without a result" % (function.__name__,
+                                                                                    process.exitcode))
+    process.join()
+    if not ok:
+        raise RuntimeError("%s failed in the isolated process:\n%s" % (function.__name__, result))
+    return result
+
+
+def parse_cpu_list(cpu_list):
+    """
+    "0-3,8,10-11" -> [0, 1, 2, 3, 8, 10, 11]
+    """
+    cores = []
+    for part in cpu_list.split(','):
+        if '-' in part:
+            first, last = map(int, part.split('-'))
+            cores.extend(range(first, last + 1))
+        elif part:
+            cores.append(int(part))
+    return cores
+
+
+def available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(multiprocessing.cpu_count()))
+
+
+def set_cpu_affinity(cores):
+    """
+    Pins the calling thread, and every thread it starts afterwards, to cores (Linux only).
+    """
+    if not hasattr(os, "sched_setaffinity"):
+        print("CPU affinity is not supported on this platform, ignoring it")
+        return
+    os.sched_setaffinity(0, cores)
+
+
+def code_version():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
 
 def save_imshow_grid(images, logs_dir, filename, shape):
     """